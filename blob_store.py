@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+import db_handler
+import db_async
+
+logger = logging.getLogger(__name__)
+
+# Photos users send are stored once per content, named by their SHA-256 and
+# sharded into blobs/ab/cd/<sha256>.jpg so no directory grows too large.
+# Downloads go to a temporary file first and are renamed into place
+# atomically, so two users (or two re-sends) never clobber each other and a
+# duplicate upload costs no disk space. The blobs table counts how many
+# users/hrv rows point at each file (kept up to date by triggers, see
+# initdatabase._blobs_v5) and gc() removes files nothing points at.
+ROOT = 'blobs'
+# unreferenced blobs younger than this are kept, their row may be on its way
+GC_GRACE = 3600
+
+def blob_path(sha, suffix='.jpg'):
+    return os.path.join(ROOT, sha[:2], sha[2:4], sha + suffix)
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# moves a finished download into place, returns (sha, path, size)
+def _commit(tmp, suffix):
+    sha = _sha256(tmp)
+    path = blob_path(sha, suffix)
+    size = os.path.getsize(tmp)
+    if os.path.exists(path):
+        # same content is already stored
+        os.unlink(tmp)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+    return sha, path, size
+
+# a blob stored again restarts its gc grace period, so gc can't remove it
+# before the row that is about to reference it is written
+def _register(sha, path, size):
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('INSERT INTO blobs (sha256, path, size, refcount, created_at) '
+            'VALUES (?, ?, ?, 0, ?) '
+            'ON CONFLICT(sha256) DO UPDATE SET created_at=excluded.created_at',
+            (sha, path, size, int(time.time())))
+
+async def store(telegram_file, suffix='.jpg'):
+    """Downloads a telegram File into the store and returns its path.
+
+    The path is what users/hrv rows should reference.
+    """
+    tmpdir = os.path.join(ROOT, 'tmp')
+    os.makedirs(tmpdir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=tmpdir, suffix=suffix)
+    os.close(fd)
+    try:
+        await telegram_file.download(custom_path=tmp)
+        sha, path, size = await asyncio.to_thread(_commit, tmp, suffix)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    await db_async.write(_register, sha, path, size)
+    logger.debug("Stored blob %s (%d bytes)", path, size)
+    return path
+
+# deletes blobs no row references anymore, returns how many were removed
+def gc(grace=GC_GRACE):
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('SELECT sha256, path FROM blobs WHERE refcount <= 0 AND created_at < ?',
+            (int(time.time()) - grace,))
+        stale = cur.fetchall()
+        for sha, path in stale:
+            cur.execute('DELETE FROM blobs WHERE sha256=? AND refcount <= 0', (sha,))
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    return len(stale)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    logger.info("Removed %d unreferenced blobs", gc())
@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+# using separate configuration and parser
+from configparser import ConfigParser
+
+import db_async
+import instrumentation
+# rendered charts are written the same (atomic) way render_service saves them
+from render_service import save_png
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+
+# ChartCache keeps rendered /plot charts so an unchanged chart is neither
+# re-queried nor re-rendered. Entries are keyed on (user, series, time
+# range, width, data high-water mark); the high-water mark changes with
+# every new row, so a stale chart is never served. Charts live in a memory
+# LRU and a disk directory whose size is kept as a running total; once it
+# outgrows disk_bytes the least recently used charts are evicted down to
+# 90% of it, so a full cache isn't rescanned on every put. For each chart
+# the Telegram file_id of the sent photo is remembered too, so a repeat
+# view is re-sent by id without uploading anything.
+class ChartCache:
+    """Two tier (memory + disk) LRU cache of rendered charts."""
+
+    def __init__(self, folder, memory_entries=128, disk_bytes=200 * 1024 * 1024):
+        self.folder = folder
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        # key -> [png, file_id]
+        self._memory = OrderedDict()
+        # bumped by invalidate, covers rows written but not yet committed
+        # (buffered ingestion) which don't move the high-water mark yet
+        self._generation = {}
+        # bytes of .png files on disk, None until the folder was scanned
+        self._disk_size = None
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, user_id, series, start, end, width, high_water):
+        generation = self._generation.get((user_id, series), 0)
+        return (user_id, series, start, end, width, high_water, generation)
+
+    def _path(self, key, suffix):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.folder, name + suffix)
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key, '.png'), 'rb') as f:
+                png = f.read()
+        except FileNotFoundError:
+            return None
+        # touch it so disk eviction sees it as recently used
+        os.utime(self._path(key, '.png'))
+        try:
+            with open(self._path(key, '.fid')) as f:
+                file_id = f.read() or None
+        except FileNotFoundError:
+            file_id = None
+        return [png, file_id]
+
+    async def get(self, key):
+        """Returns (png, file_id) of a cached chart, None on a miss."""
+        entry = self._memory.get(key)
+        if entry is None:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+        else:
+            self._memory.move_to_end(key)
+        self.hits += 1
+        return tuple(entry)
+
+    def _size(self, path):
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    def _write_disk(self, key, png, file_id):
+        path = self._path(key, '.png')
+        with self._disk_lock:
+            if self._disk_size is None:
+                self._evict_disk(self.disk_bytes)
+            if png is not None:
+                old = self._size(path)
+                save_png(png, path)
+                self._disk_size += len(png) - old
+            # the chart may have been evicted meanwhile, don't leave its id behind
+            if file_id is not None and os.path.exists(path):
+                with open(self._path(key, '.fid'), 'w') as f:
+                    f.write(file_id)
+            if self._disk_size > self.disk_bytes:
+                self._evict_disk(self.disk_bytes * 9 // 10)
+
+    # removes the least recently used charts until limit bytes are left, and
+    # .fid files whose chart is gone; recounts the running size
+    def _evict_disk(self, limit):
+        try:
+            entries = list(os.scandir(self.folder))
+        except FileNotFoundError:
+            self._disk_size = 0
+            return
+        names = {e.name for e in entries}
+        charts = []
+        for e in entries:
+            if e.name.endswith('.png'):
+                stat = e.stat()
+                charts.append((stat.st_mtime, stat.st_size, e.path))
+            elif e.name.endswith('.fid') and e.name[:-len('.fid')] + '.png' not in names:
+                self._unlink(e.path)
+        total = sum(size for _, size, _ in charts)
+        for _, size, path in sorted(charts):
+            if total <= limit:
+                break
+            self._unlink(path)
+            self._unlink(path[:-len('.png')] + '.fid')
+            total -= size
+        self._disk_size = total
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    async def put(self, key, png, file_id=None):
+        """Stores a rendered chart (and the file_id it was sent with)."""
+        self._remember(key, [png, file_id])
+        await asyncio.to_thread(self._write_disk, key, png, file_id)
+
+    async def set_file_id(self, key, file_id):
+        entry = self._memory.get(key)
+        if entry is not None:
+            entry[1] = file_id
+        await asyncio.to_thread(self._write_disk, key, None, file_id)
+
+    def invalidate(self, user_id, series=None):
+        """Drops the user's charts from memory, called when new rows arrive.
+
+        Disk entries of the old high-water mark are simply never asked for
+        again and age out.
+        """
+        if series is not None:
+            self._generation[(user_id, series)] = self._generation.get((user_id, series), 0) + 1
+        for key in [k for k in self._memory if k[0] == user_id and series in (None, k[1])]:
+            del self._memory[key]
+
+
+# shared cache, see [CHART_CACHE] in env-example.cfg
+cache = ChartCache(
+    cfg.get('CHART_CACHE', 'folder', fallback='chart_cache'),
+    memory_entries=cfg.getint('CHART_CACHE', 'memory_entries', fallback=128),
+    disk_bytes=cfg.getint('CHART_CACHE', 'disk_mb', fallback=200) * 1024 * 1024,
+)
+
+# new rows make the user's cached charts of that series stale
+db_async.on_new_data(cache.invalidate)
+
+instrumentation.gauge('chart_cache_hits', lambda: cache.hits)
+instrumentation.gauge('chart_cache_misses', lambda: cache.misses)
@@ -13,12 +13,12 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 
-import logging, sqlite3, requests, json, re
-import matplotlib.pyplot as plt
-from msilib.schema import Error
+import logging, os, re
+from contextlib import ExitStack
 
 from telegram import __version__ as TG_VER
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram import InputMediaPhoto, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -55,14 +55,43 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-# Create database
-db = sqlite3.connect('database.db')
-def savedb():
-    print("Users Table:")
-    [print(i) for i in db.execute("SELECT * FROM users")]
-    print("HRV Table:")
-    [print(i) for i in db.execute("SELECT * FROM hrv")]
-    db.commit()
+# Create database, all access goes through the non-blocking db_async layer
+import initdatabase
+import db_async
+import persistence
+import webhook
+import instrumentation
+import throttle
+# uploaded photos are stored content addressed, once per distinct image
+import blob_store
+import download_queue
+# charts are drawn by worker processes, off the event loop
+import data_plotter
+import render_service
+# pooled async client for the ecg4everybody requests, and the cache in front of it
+import httpx
+import http_client
+import hrv_cache
+# raw graph arrays of the users' payloads and the metrics computed from them
+import hrv_store
+import hrv_metrics
+
+initdatabase.initbotdb()
+
+
+# id of the users/hrv row the running conversation fills in. It is kept in
+# context.user_data so each step updates that one row by primary key; if it
+# is missing (e.g. the bot restarted mid conversation) the user's newest row
+# is used, and a new one is started if they have none.
+async def session_row(context: ContextTypes.DEFAULT_TYPE, table: str, user) -> int:
+    key = table + "_row"
+    if key not in context.user_data:
+        row_id = await db_async.latest_row(table, user.id)
+        if row_id is None:
+            add = db_async.add_user if table == "users" else db_async.add_hrv
+            row_id = await add(user.id, user.first_name)
+        context.user_data[key] = row_id
+    return context.user_data[key]
 
 
 
@@ -74,6 +103,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "/conv to have a casual conversation with me.\n"
         "/link to send your data.\n"
         "/plot to plot your stored data.\n"
+        "/metrics to see the HRV metrics of your stored data.\n"
         "/input to store your HRV photos.\n"
         "/restore to restore/see your photos from the database.\n"
     )
@@ -83,18 +113,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 GENDER, PHOTO, LOCATION, BIO = range(4)
 
-db.execute("CREATE TABLE IF NOT EXISTS users(\
-	id INTEGER NOT NULL PRIMARY KEY,\
-	name TEXT, gender TEXT,eresponsephoto TEXT,\
-    location TEXT, bio TEXT)")
-
 
 async def conv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks the user about their gender."""
     user = update.message.from_user
     reply_keyboard = [["Boy", "Girl", "Other"]]
-    db.execute("INSERT INTO users (name) VALUES (?)", [user.first_name])
-    savedb()
+    context.user_data["users_row"] = await db_async.add_user(user.id, user.first_name)
 
     await update.message.reply_text(
         "Hi! I am Myron's Bot ;) I will hold a conversation with you. "
@@ -112,8 +136,8 @@ async def gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the selected gender and asks for a photo."""
     user = update.message.from_user
     logger.info("Gender of %s: %s", user.first_name, update.message.text)
-    db.execute("UPDATE users SET gender=? WHERE name=?", [update.message.text, user.first_name])
-    savedb()
+    row_id = await session_row(context, "users", user)
+    await db_async.update_user(row_id, "gender", update.message.text)
 
     await update.message.reply_text(
         "I see! Please send me a photo of yourself, "
@@ -128,12 +152,11 @@ async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the photo and asks for a location."""
     user = update.message.from_user
     photo_file = await update.message.photo[-1].get_file()
-    filename = 'users/'+ user.first_name + user.last_name + ".jpg"
-    await photo_file.download(filename)
+    filename = await blob_store.store(photo_file)
     logger.info("Photo of %s: %s", user.first_name, filename)
 
-    db.execute("UPDATE users SET photo=? WHERE name=?", [filename, user.first_name])
-    savedb()
+    row_id = await session_row(context, "users", user)
+    await db_async.update_user(row_id, "photo", filename)
 
     await update.message.reply_text(
         "Gorgeous! Now, send me your location please, or send /skip if you don't want to."
@@ -161,8 +184,10 @@ async def location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "Location of %s: %f / %f", user.first_name, user_location.latitude, user_location.longitude
     )
     
-    db.execute("UPDATE users SET location=? WHERE name=?", [user_location, user.first_name])
-    savedb()
+    row_id = await session_row(context, "users", user)
+    await db_async.update_user(
+        row_id, "location", f"{user_location.latitude},{user_location.longitude}"
+    )
 
     await update.message.reply_text(
         "Maybe I can visit you sometime! At last, tell me something about yourself."
@@ -186,8 +211,8 @@ async def bio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the info about the user and ends the conversation."""
     user = update.message.from_user
     logger.info("Bio of %s: %s", user.first_name, update.message.text)
-    db.execute("UPDATE users SET bio=? WHERE name=?", [update.message.text, user.first_name])
-    savedb()
+    row_id = await session_row(context, "users", user)
+    await db_async.update_user(row_id, "bio", update.message.text)
 
     await update.message.reply_text("Thank you! I hope we can talk again some day.")
 
@@ -202,8 +227,6 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "Bye! I hope we can talk again some day.", reply_markup=ReplyKeyboardRemove()
     )
 
-    db.close()
-
     return ConversationHandler.END
 
 
@@ -211,20 +234,12 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 SUMMARY, GRAPHS, DETAILS = range(3)
 
-db.execute("CREATE TABLE IF NOT EXISTS hrv(\
-	id INTEGER NOT NULL PRIMARY KEY, name TEXT,\
-    summareresponse TEXT, graphs TEXT, details TEXT)")
-def savedb():
-    [print(i) for i in db.execute("SELECT * FROM hrv")]
-    db.commit()
-
 
 async def hrv_photos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the process of inputing hrv diagrams."""
     user = update.message.from_user
     logger.info("The user %s started hrv saving process", user.first_name)
-    db.execute("INSERT INTO hrv (name) VALUES (?)", [user.first_name])
-    savedb()
+    context.user_data["hrv_row"] = await db_async.add_hrv(user.id, user.first_name)
 
     await update.message.reply_text(
         "Hello there! I am the hrv bot.. \n"
@@ -236,13 +251,11 @@ async def hrv_photos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
-    photo_file = await update.message.photo[-1].get_file()
-    filename = 'hrv/'+ user.first_name + user.last_name + "-summary" +".jpg"
-    await photo_file.download(filename)
-    logger.info("Photo of %s: %s", user.first_name, filename)
+    logger.info("Summary photo of %s received", user.first_name)
 
-    db.execute("UPDATE hrv SET summary=? WHERE name=?", [filename, user.first_name])
-    savedb()
+    # saved in the background, the row's summary is set once it is on disk
+    row_id = await session_row(context, "hrv", user)
+    await download_queue.submit(update.message.photo, "hrv", row_id, "summary")
 
     await update.message.reply_text(
         "Great! Your data has been saved in the DataBase! \n"
@@ -254,13 +267,10 @@ async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def graphs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
-    photo_file = await update.message.photo[-1].get_file()
-    filename = 'hrv/'+ user.first_name + user.last_name + "-graphs" +".jpg"
-    await photo_file.download(filename)
-    logger.info("Photo of %s: %s", user.first_name, filename)
+    logger.info("Graphs photo of %s received", user.first_name)
 
-    db.execute("UPDATE hrv SET graphs=? WHERE name=?", [filename, user.first_name])
-    savedb()
+    row_id = await session_row(context, "hrv", user)
+    await download_queue.submit(update.message.photo, "hrv", row_id, "graphs")
 
     await update.message.reply_text(
         "Great! Your graphs has been saved in the DataBase! \n"
@@ -272,13 +282,10 @@ async def graphs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def details(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
-    photo_file = await update.message.photo[-1].get_file()
-    filename = 'hrv/'+ user.first_name + user.last_name + "-details" +".jpg"
-    await photo_file.download(filename)
-    logger.info("Photo of %s: %s", user.first_name, filename)
+    logger.info("Details photo of %s received", user.first_name)
 
-    db.execute("UPDATE hrv SET details=? WHERE name=?", [filename, user.first_name])
-    savedb()
+    row_id = await session_row(context, "hrv", user)
+    await download_queue.submit(update.message.photo, "hrv", row_id, "details")
 
     await update.message.reply_text(
         "Great! Your hrv details has been saved in the DataBase! \n"
@@ -301,23 +308,66 @@ async def skip_hrv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 ########## HRV PHOTO SHOW ##########
 
+# Sends photos as a single media group (one API call) with captions. Each
+# item is (file_id, source, caption): a known file_id is sent by id, without
+# uploading, otherwise source (a path or PNG bytes) is uploaded. Returns the
+# file_id telegram now knows every photo by.
+async def send_photos(update: Update, items: list) -> list:
+    with ExitStack() as files:
+        def media(file_id, source, caption):
+            if file_id is None and isinstance(source, str):
+                source = files.enter_context(open(source, 'rb'))
+            return InputMediaPhoto(media=file_id or source, caption=caption)
+
+        async def send(medias):
+            # a media group needs at least two photos
+            if len(medias) == 1:
+                message = await update.message.reply_photo(photo=medias[0].media, caption=medias[0].caption)
+                return [message]
+            return await update.message.reply_media_group(media=medias)
+
+        try:
+            messages = await send([media(*item) for item in items])
+        except BadRequest:
+            if all(file_id is None for file_id, _, _ in items):
+                raise
+            # a stored file_id is no longer valid, upload everything
+            logger.warning("Stored file_id rejected, uploading the photos again")
+            messages = await send([media(None, source, caption) for _, source, caption in items])
+    return [message.photo[-1].file_id for message in messages]
+
+
 async def restore(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Restore the data stored for the user."""
     user = update.message.from_user
     logger.info("The data of user %s has been plotted.", user.first_name)
     
-    data = db.execute("SELECT summary,graphs,details from hrv WHERE name=?", [user.first_name]).fetchall()
-
-    # str_data = "\n".join([" ".join(d) for d in data])
-
-    await update.message.reply_photo(photo=open(data[-1][0], 'rb'))
-    await update.message.reply_text("This is your Summary picture.")
-    for datafile, dataname in zip(data[-1][1:], ["Graphs","Details"]):
-        try:
-            await update.message.reply_photo(photo=open(datafile, 'rb'))
-            await update.message.reply_text(f"This is your {dataname}.")
-        except TypeError:
-            await update.message.reply_text(f"You haven't stored any {dataname}.. Use /input if you want to do so.")
+    # a /restore sent while the user's previous one still runs shares its
+    # read, every update gets its own reply
+    data = await throttle.coalesce(("restore", user.id), db_async.get_hrv, user.id)
+    if data is None or data[1] is None:
+        await update.message.reply_text("You haven't stored any HRV photos.. Use /input if you want to do so.")
+        return
+
+    row_id, paths, file_ids = data[0], data[1:4], data[4:7]
+    items, columns, missing = [], [], []
+    for column, dataname, datafile, file_id in zip(
+        ["summary", "graphs", "details"], ["Summary picture", "Graphs", "Details"], paths, file_ids
+    ):
+        if datafile is None:
+            missing.append(dataname)
+            continue
+        items.append((file_id, datafile, f"This is your {dataname}."))
+        columns.append((column, file_id))
+
+    sent = await send_photos(update, items)
+    # remember new file_ids so the next /restore uploads nothing
+    for (column, file_id), new_id in zip(columns, sent):
+        if new_id != file_id:
+            await db_async.update_hrv(row_id, column + "_file_id", new_id)
+
+    for dataname in missing:
+        await update.message.reply_text(f"You haven't stored any {dataname}.. Use /input if you want to do so.")
 
 
 ########## DATA PROCESSING ##########
@@ -331,29 +381,49 @@ async def hrv_ask_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     return GETDATA
 
 
+# where the user's rendered graph is kept, named by telegram id so users
+# with the same (or no) last name don't overwrite each other's plots
+def plot_path(user, title: str) -> str:
+    return f"plots/{user.id}-{title}_plot.png"
+
+
 async def hrv_get_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Processes and plot the data stored for the user."""
     user = update.message.from_user
-    filename = 'plots/'+ user.first_name+user.last_name +"-"
     logger.info("HRV link of %s: %s", user.first_name, update.message.text)
 
-    resp = requests.post('https://ecg4everybody.com/service/getdata.php', data = {'i': re.search('i=(\w+)', update.message.text).group(1)})
-    resp = json.loads(resp.text)
-    # [print(r, resp[r]) for r in resp]
-    
-    for graph in resp['graph_arrays']:
-        data = graph['data']
-        scale = graph['scale'] if 'scale' in graph else ""
-        title = graph['title'] if 'title' in graph else ""
-        x_unit = graph['x_unit'] if 'x_unit' in graph else ""
-        y_unit = graph['y_unit'] if 'y_unit' in graph else ""
-
-        plt.plot([d/scale for d in data])
-        plt.title(title)
-        plt.xlabel(x_unit)
-        plt.ylabel(y_unit)
-        plt.savefig(filename + title +"_plot.png")
-        plt.close()
+    token = re.search(r'i=(\w+)', update.message.text)
+    if token is None:
+        await update.message.reply_text("That doesn't look like an ecg4everybody.com link, please send it again.")
+        return GETDATA
+
+    try:
+        # repeated links are answered from the cache without any network
+        # users sending the same link at once share one fetch
+        resp = await throttle.coalesce(("link", token.group(1)), hrv_cache.fetch, token.group(1))
+    except (httpx.HTTPError, ValueError):
+        logger.exception("Fetching hrv data of %s failed", user.first_name)
+        await update.message.reply_text("I couldn't get your data from ecg4everybody.com, please try again later.")
+        return ConversationHandler.END
+
+    # keep the raw arrays so re-plots and metrics don't need a re-fetch
+    await db_async.write(hrv_store.save_graphs, user.id, token.group(1), resp['graph_arrays'])
+
+    # every graph of the payload is scaled with numpy and rendered in one
+    # pass by a worker process, each image is kept on disk for /plot
+    graphs = resp['graph_arrays']
+    try:
+        await render_service.render_many(
+            [data_plotter.graph_spec(graph) for graph in graphs],
+            save_to=[plot_path(user, title) for title in hrv_store.titles(graphs)],
+        )
+    except render_service.RenderBusy:
+        # the arrays are stored, /plot draws the missing images from them
+        await update.message.reply_text(
+            "Your data has been stored, but I'm drawing a lot of charts right now. "
+            "Send anything in a moment and I'll plot it."
+        )
+        return PLOT
 
     await update.message.reply_text("Your data has been succesfully stored in my database.")
 
@@ -363,17 +433,93 @@ async def hrv_get_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 async def plot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Processes and plot the data stored for the user."""
     user = update.message.from_user
-    filename = 'plots/'+ user.first_name+user.last_name +"-"
-
+    try:
+        # a /plot sent while the user's previous one still runs shares its
+        # reads and renders, every update gets its own reply
+        graphs = await throttle.coalesce(("plot", user.id), plot_sources, user)
+    except render_service.RenderBusy:
+        await update.message.reply_text(
+            "I'm drawing a lot of charts right now, please try /plot again in a moment."
+        )
+        return
+
+    items, titles = [], []
+    for title, graph in graphs:
+        if graph is None:
+            await update.message.reply_text(f"You have no {title} graph yet.. Send me your data with /link.")
+            continue
+        file_id, source = graph
+        items.append((file_id, source, f"This is the {title} graph from your data."))
+        titles.append((title, file_id))
+    if not items:
+        return
+
+    sent = await send_photos(update, items)
+    for (title, file_id), new_id in zip(titles, sent):
+        if new_id != file_id:
+            await db_async.write(hrv_store.set_file_id, user.id, title, new_id)
+
+
+# (title, (file_id, path or PNG bytes) or None) of the graphs /plot sends,
+# raises RenderBusy if a missing image can't be re-plotted right now
+async def plot_sources(user) -> list:
+    graphs = []
     for title in ['PSD', 'AR PSD']:
-        await update.message.reply_photo(photo=open(filename +title+'_plot.png', 'rb'))
-        await update.message.reply_text(f"This is the {title} graph from your data.")
+        graph = await db_async.read(hrv_store.load_graph, user.id, title)
+        if graph is None:
+            graphs.append((title, None))
+            continue
+        source = plot_path(user, title)
+        if graph['file_id'] is None and not os.path.exists(source):
+            # the image is gone, re-plot it from the stored arrays
+            source = await render_service.render(data_plotter.graph_spec(graph), save_to=source)
+        graphs.append((title, (graph['file_id'], source)))
+    return graphs
+
+
+# answers updates that arrive while the conversation's previous one is still
+# being handled (its handler runs with block=False)
+async def still_working(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_message is not None:
+        await update.effective_message.reply_text("I'm still working on your last message, one moment please.")
+
+
+# closes the pooled http connections while the event loop is still running
+async def close(application: Application) -> None:
+    # let queued photo downloads finish before the bot goes away
+    await download_queue.close()
+    await http_client.aclose()
+    # finish queued database writes
+    db_async.shutdown()
+    # stop the chart render workers
+    render_service.shutdown()
+
+
+async def metrics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends the HRV metrics computed from the user's stored data."""
+    user = update.message.from_user
+    logger.info("Metrics of %s requested", user.first_name)
 
+    # cached per payload, computed (and cached) on the writer thread otherwise
+    result = await db_async.write(hrv_metrics.user_metrics, user.id)
+    if result is None:
+        await update.message.reply_text("I have no RR data of yours.. Send me your data with /link.")
+        return
+    await update.message.reply_text(hrv_metrics.format_metrics(result))
 
-def main() -> None:
-    """Run the bot."""
+
+def build_application() -> Application:
+    """Creates the bot's Application with all handlers added."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(cfg['TELEGRAM']['token']).build()
+    application = (
+        Application.builder()
+        .token(cfg['TELEGRAM']['token'])
+        # conversations and user_data survive restarts
+        .persistence(persistence.SqlitePersistence('conversationbot_state.db'))
+        .post_shutdown(close)
+        .concurrent_updates(throttle.CONCURRENT_UPDATES)
+        .build()
+    )
 
     # Add conversation handler with the states GENDER, PHOTO, LOCATION and BIO
     conv_handler = ConversationHandler(
@@ -388,6 +534,8 @@ def main() -> None:
             BIO: [MessageHandler(filters.TEXT & ~filters.COMMAND, bio)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="conv_handler",
+        persistent=True,
     )
 
     hrv_photo_handler = ConversationHandler(
@@ -398,29 +546,45 @@ def main() -> None:
             DETAILS: [MessageHandler(filters.PHOTO, details), CommandHandler("skip", skip_hrv)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="hrv_photo_handler",
+        persistent=True,
     )
     
     hrv_link_handler = ConversationHandler(
         entry_points=[CommandHandler("link", hrv_ask_link)],
         states={
-            GETDATA: [MessageHandler(filters.TEXT, hrv_get_link)],
-            PLOT: [MessageHandler(filters.TEXT, plot)],
+            GETDATA: [MessageHandler(filters.TEXT, hrv_get_link, block=False)],
+            PLOT: [MessageHandler(filters.TEXT, plot, block=False)],
+            ConversationHandler.WAITING: [MessageHandler(filters.ALL, still_working)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="hrv_link_handler",
+        persistent=True,
     )
 
 
+    # per user and per command limits run before any of the handlers below
+    throttle.install(application)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(conv_handler)
     application.add_handler(hrv_photo_handler)
-    application.add_handler(CommandHandler("restore", restore))
+    application.add_handler(CommandHandler("restore", restore, block=False))
     application.add_handler(hrv_link_handler)
-    application.add_handler(CommandHandler("plot", plot))
+    application.add_handler(CommandHandler("plot", plot, block=False))
+    application.add_handler(CommandHandler("metrics", metrics))
+
+    # handler latencies and errors, served on /metrics when [METRICS] is enabled
+    instrumentation.install(application)
 
-    # Run the bot until the user presses Ctrl+C
-    application.run_polling()
+    return application
 
 
+def main() -> None:
+    """Run the bot."""
+    # Run the bot until the user presses Ctrl+C, by long polling or as
+    # webhook workers when [WEBHOOK] is enabled
+    webhook.run(build_application)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,27 +1,105 @@
-import matplotlib.pyplot as plt
+import io
+import time
+
+# Agg renders straight to PNG without a display, the bots never open windows
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.dates as mdates
 import numpy
 
-# includes a lot of parsing
+from matplotlib.figure import Figure
+
+# rows come from the database as (ts, value) tuples, where ts is either the
+# epoch seconds of db_handler.get_series or the local time date string of
+# db_handler.getdatapoint. numpy converts the whole list in one pass, with no
+# per-row python parsing.
+EPOCH_ROWS = numpy.dtype([('ts', 'i8'), ('value', 'f8')])
+DATE_ROWS = numpy.dtype([('ts', 'datetime64[s]'), ('value', 'f8')])
+
+# turns database rows into (datetime64 local times, float values) arrays
+def to_arrays(data):
+    if len(data) and isinstance(data[0][0], str):
+        rows = numpy.array(data, dtype=DATE_ROWS)
+        return rows['ts'], rows['value']
+    rows = numpy.array(data, dtype=EPOCH_ROWS)
+    # datetime64 has no timezone, shift epoch seconds so the axis shows
+    # local time like the date strings do
+    local = rows['ts'] + time.localtime().tm_gmtoff
+    return local.astype('datetime64[s]'), rows['value']
+
+# A plot spec describes one chart as plain data, so it can be sent to a
+# render worker process:
+#   {'series': [{'x': array or None, 'y': array, 'label': str}, ...],
+#    'title': str, 'xlabel': str, 'ylabel': str, 'size': (width, height) px}
+# Only 'series' is required; a series without 'x' is plotted against its index.
+DPI = 100
+
+# builds the spec for a user's stored datapoints
+def data_spec(data, label='data'):
+    times, values = to_arrays(data)
+    return {
+        'series': [{'x': times, 'y': values, 'label': label}],
+        'xlabel': 'Time',
+        'ylabel': 'Value (unit)',
+    }
+
+# builds the spec for one graph of an ecg4everybody payload (or hrv_store).
+# The data is converted to a float32 array once and scaled in place; a
+# missing or empty scale means the values are already in their unit.
+def graph_spec(graph):
+    values = numpy.array(graph['data'], dtype=numpy.float32)
+    scale = graph.get('scale')
+    if scale not in (None, "", 0):
+        values /= float(scale)
+    return {
+        'series': [{'y': values}],
+        'title': graph.get('title') or "",
+        'xlabel': graph.get('x_unit') or "",
+        'ylabel': graph.get('y_unit') or "",
+    }
+
+# one Figure per chart size, cleared and reused for every render in this
+# process instead of building a new one each time
+_figures = {}
+
+def _figure(size):
+    fig = _figures.get(size)
+    if fig is None:
+        width, height = size
+        # a bare Figure isn't tracked by pyplot, so nothing leaks between charts
+        fig = _figures[size] = Figure(figsize=(width / DPI, height / DPI), dpi=DPI)
+    else:
+        fig.clear()
+    return fig
+
+# renders a plot spec and returns the PNG bytes
+def render(spec):
+    fig = _figure(tuple(spec.get('size', (640, 480))))
+    ax = fig.add_subplot()
+    for series in spec['series']:
+        x = series.get('x')
+        if x is None:
+            ax.plot(series['y'], label=series.get('label'))
+        else:
+            ax.plot(x, series['y'], label=series.get('label'))
+        if x is not None and numpy.asarray(x).dtype.kind == 'M':
+            ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(ax.xaxis.get_major_locator()))
+    if len(spec['series']) > 1:
+        ax.legend()
+    ax.set_title(spec.get('title', ''))
+    ax.set_xlabel(spec.get('xlabel', ''))
+    ax.set_ylabel(spec.get('ylabel', ''))
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+# renders several specs in one go (e.g. every graph of a payload) on the
+# reused figure and returns their PNG bytes in the same order
+def render_many(specs):
+    return [render(spec) for spec in specs]
+
+# renders the user's datapoints in this process and returns the PNG bytes,
+# the bots use render_service to do this in a worker process instead
 def plot(data):
-    hrv_datetime = {}
-    hrv_timestamps = []
-    hrv_datapoints = []
-    for row in data:
-        print(row)
-        date = row[0].split(" ")[0]
-        time = row[0].split(" ")[1]
-        hrv_datetime['year'] = int(date.split("-")[0])
-        hrv_datetime['month'] = int(date.split("-")[1])
-        hrv_datetime['day'] = int(date.split("-")[2])
-        hrv_datetime['hour'] = int(time.split(":")[0])
-        hrv_datetime['minute'] = int(time.split(":")[1])
-        print(hrv_datetime['month'])
-        print(hrv_datetime['day'])
-        print(hrv_datetime['hour'])
-        hrv_timestamps.append(hrv_datetime['day'])
-        hrv_datapoints.append(int(row[1]))
-
-    plt.plot(hrv_datapoints)
-    plt.xlabel('Time')
-    plt.ylabel('Value (unit)')
-    plt.savefig('data_plot.png')
+    return render(data_spec(data))
@@ -25,9 +25,13 @@ from telegram.ext import (
 
 # using separate configuration and parser
 from configparser import ConfigParser
-# import initdb and handler to it
+# import initdb
 import initdatabase
-import db_handler
+# non-blocking wrappers around db_handler for the async handlers
+import db_async
+import persistence
+import webhook
+import instrumentation
 
 # configparser
 cfg = ConfigParser()
@@ -92,8 +96,14 @@ async def store_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     new_data = update.message.text
 
     # we are calling add_data method from database handler
-    # # it takes the new_data as parameter 
-    db_handler.add_data(new_data)
+    # it takes the new_data and the user's id as parameters
+    try:
+        await db_async.add_data(new_data, user.id)
+    except ValueError:
+        await update.message.reply_text(
+            "That is not a number, please send a numeric value: "
+        )
+        return STOREDATA
 
     # Logging new_data and username
     logger.info(
@@ -107,12 +117,20 @@ async def store_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
     return ConversationHandler.END
 
-def main() -> None:
-    """Run the bot."""
+async def close(application: Application) -> None:
+    # flush buffered datapoints, finish queued writes and return the pooled connections
+    db_async.shutdown()
+
+
+def build_application() -> Application:
+    """Creates the bot's Application with all handlers added."""
     # Create the Application and pass it your bot's token.
     application = (
         Application.builder()
         .token(TOKEN)
+        .post_shutdown(close)
+        # conversations and user_data survive restarts
+        .persistence(persistence.SqlitePersistence('database_test_state.db'))
         .build()
     )
 
@@ -123,14 +141,25 @@ def main() -> None:
             STOREDATA: [MessageHandler(filters.TEXT & ~filters.COMMAND, store_data)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="storedata_handler",
+        persistent=True,
     )
 
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("start", start))
     application.add_handler(storedata_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    # handler latencies and errors, served on /metrics when [METRICS] is enabled
+    instrumentation.install(application)
+
+    return application
+
+
+def main() -> None:
+    """Run the bot."""
+    # Run the bot until the user presses Ctrl-C, by long polling or as
+    # webhook workers when [WEBHOOK] is enabled
+    webhook.run(build_application)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,125 @@
+import asyncio
+import functools
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# the blocking sqlite work lives in db_handler, this module only moves it off
+# the event loop so one slow commit doesn't stall every other user's handler
+import db_handler
+import instrumentation
+
+# all writes go through one dedicated thread, so they never queue up behind
+# each other on sqlite's write lock; reads get their own threads and run
+# concurrently thanks to WAL
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_readers = ThreadPoolExecutor(max_workers=db_handler.POOL_SIZE, thread_name_prefix="db-reader")
+
+
+async def _run(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # includes the time spent waiting for a free database thread
+    with instrumentation.timed('db_call_seconds', call=getattr(func, '__name__', 'call')):
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def write(func, *args, **kwargs):
+    """Runs a blocking db_handler write on the writer thread."""
+    return await _run(_writer, func, *args, **kwargs)
+
+
+async def read(func, *args, **kwargs):
+    """Runs a blocking db_handler read on a reader thread."""
+    return await _run(_readers, func, *args, **kwargs)
+
+
+# awaitable versions of the db_handler methods
+
+# callbacks(user_id, metric) run on the event loop after add_data, e.g. to
+# drop cached charts of that series
+_new_data_listeners = []
+
+def on_new_data(callback):
+    _new_data_listeners.append(callback)
+
+async def add_data(data, user_id, metric='data'):
+    if db_handler.BUFFERED:
+        # queueing never blocks, so it can be done right here on the loop
+        fut = db_handler.queue_data(data, user_id, metric)
+        if db_handler.DURABILITY == 'commit':
+            await asyncio.wrap_future(fut)
+    else:
+        await write(db_handler.add_data, data, user_id, metric)
+    for callback in _new_data_listeners:
+        callback(user_id, metric)
+
+async def getdatapoint(user_id, metric='data'):
+    return await read(db_handler.getdatapoint, user_id, metric)
+
+async def get_range(user_id, metric='data', start=None, end=None):
+    return await read(db_handler.get_range, user_id, metric, start, end)
+
+async def get_latest(user_id, metric='data', n=100):
+    return await read(db_handler.get_latest, user_id, metric, n)
+
+async def get_series(user_id, metric='data', start=None, end=None, width=640):
+    return await read(db_handler.get_series, user_id, metric, start, end, width)
+
+async def high_water(user_id, metric='data'):
+    return await read(db_handler.high_water, user_id, metric)
+
+async def get_user_data(user_id):
+    return await read(db_handler.get_user_data, user_id)
+
+async def get_metrics(user_id):
+    return await read(db_handler.get_metrics, user_id)
+
+async def add_user(user_id, name):
+    return await write(db_handler.add_user, user_id, name)
+
+async def update_user(row_id, column, value):
+    return await write(db_handler.update_user, row_id, column, value)
+
+async def add_hrv(user_id, name):
+    return await write(db_handler.add_hrv, user_id, name)
+
+async def update_hrv(row_id, column, value):
+    return await write(db_handler.update_hrv, row_id, column, value)
+
+async def latest_row(table, user_id):
+    return await read(db_handler.latest_row, table, user_id)
+
+async def get_hrv(user_id):
+    return await read(db_handler.get_hrv, user_id)
+
+async def export(user_id, series='data', fmt='csv', compression=db_handler.EXPORT_COMPRESSION):
+    return await read(db_handler.export, user_id, series, fmt, compression)
+
+# parses the document on a reader thread and writes it one chunk at a time,
+# so other writes get the writer thread between chunks; progress(rows,
+# seconds) is called after every chunk
+async def import_data(user_id, file, progress=None):
+    started = time.perf_counter()
+    result = db_handler.import_result()
+    chunks = db_handler.import_chunks(user_id, file, result)
+    while True:
+        chunk = await read(next, chunks, None)
+        if chunk is None:
+            break
+        result['rows'] += await write(db_handler.write_import, chunk)
+        if progress is not None:
+            progress(result['rows'], time.perf_counter() - started)
+    result['seconds'] = time.perf_counter() - started
+    for metric in result['metrics']:
+        for listener in _new_data_listeners:
+            listener(user_id, metric)
+    return result
+
+
+# waits for queued writes to finish, flushes buffered datapoints and closes
+# the pooled connections, called from main() once the bot has stopped
+def shutdown():
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=True)
+    db_handler.flush()
+    db_handler.close()
@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+# BatchWriter buffers rows for one INSERT statement and writes them with a
+# single executemany inside one transaction (group commit), so a burst of
+# messages costs one fsync instead of one per row. A batch is flushed when
+# it reaches batch_size rows or when its oldest row is flush_interval
+# seconds old, whichever comes first.
+class BatchWriter:
+    """Background group-commit queue for a single INSERT statement."""
+
+    def __init__(self, sql, cursor, batch_size=200, flush_interval=1.0):
+        self.sql = sql
+        # cursor is a contextmanager like db_handler.cursor that commits on exit
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._futures = []
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="db-batch-writer", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row):
+        """Queues one row, the returned Future resolves once it is committed."""
+        fut = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("batch writer is closed")
+            if not self._rows:
+                # wake the writer so it starts the flush_interval timer
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            self._rows.append(row)
+            self._futures.append(fut)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+        return fut
+
+    def _take(self):
+        rows, futures = self._rows, self._futures
+        self._rows, self._futures, self._oldest = [], [], None
+        return rows, futures
+
+    def _write(self, rows, futures):
+        if not rows:
+            return
+        try:
+            with self.cursor() as cur:
+                cur.executemany(self.sql, rows)
+        except Exception as err:
+            logger.exception("Failed to write batch of %d rows", len(rows))
+            for fut in futures:
+                fut.set_exception(err)
+            return
+        logger.debug("Committed batch of %d rows", len(rows))
+        for fut in futures:
+            fut.set_result(None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._rows) >= self.batch_size:
+                        break
+                    if self._rows:
+                        left = self._oldest + self.flush_interval - time.monotonic()
+                        if left <= 0:
+                            break
+                        self._cond.wait(left)
+                    else:
+                        self._cond.wait()
+                closed = self._closed
+                rows, futures = self._take()
+            self._write(rows, futures)
+            if closed:
+                return
+
+    def flush(self):
+        """Writes everything queued so far on the calling thread."""
+        with self._cond:
+            rows, futures = self._take()
+        self._write(rows, futures)
+
+    def close(self):
+        """Flushes the remaining rows and stops the background thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
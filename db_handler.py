@@ -1,37 +1,566 @@
 import sqlite3 as sq
-# using datatime to get the exact timestamp
-import datetime as dt 
+import csv
+import gzip
+import io
+import itertools
+import json
+import logging
+import random
+import struct
+import tempfile
+# using time to get the exact timestamp
+import time
+import zlib
 
 from contextlib import contextmanager
+from datetime import datetime, timezone
+# using separate configuration and parser
+from configparser import ConfigParser
 
-# we are using contextmanager from contextlib for creating connection to already
-# initiated database
+# packs the columns of columnar exports
+import numpy
+
+# pool of long-lived connections shared by every handler
+import db_pool
+# group-commit queue for buffered ingestion
+from db_batch import BatchWriter
+# query timings, see [METRICS]
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+DATABASE = 'eestec.db'
+
+# pool settings, see [DATABASE] in env-example.cfg
+POOL_SIZE = cfg.getint('DATABASE', 'pool_size', fallback=4)
+BUSY_TIMEOUT = cfg.getint('DATABASE', 'busy_timeout', fallback=5000)
+
+# buffered ingestion settings, see [INGEST] in env-example.cfg
+BUFFERED = cfg.getboolean('INGEST', 'buffered', fallback=False)
+BATCH_SIZE = cfg.getint('INGEST', 'batch_size', fallback=200)
+FLUSH_INTERVAL = cfg.getfloat('INGEST', 'flush_interval', fallback=1.0)
+# 'commit' waits until the batch holding the value is committed,
+# 'queued' returns as soon as the value is buffered (faster, but the last
+# flush_interval seconds of values are lost if the bot crashes)
+DURABILITY = cfg.get('INGEST', 'durability', fallback='commit')
+if DURABILITY not in ('commit', 'queued'):
+    raise ValueError(f"[INGEST] durability must be 'commit' or 'queued', not {DURABILITY!r}")
+
+# share of users/hrv writes whose changed row gets logged, see [DEBUG]
+TRACE_SAMPLE_RATE = cfg.getfloat('DEBUG', 'trace_sample_rate', fallback=0.0)
+
+# we are using contextmanager from contextlib for borrowing a connection to
+# already initiated database from the pool
 @contextmanager
-def cursor():
-    try:
-        # using connect, sqlite will try to open the file
-        conn = sq.connect('eestec.db')
+def cursor(db=DATABASE):
+    pool = db_pool.get_pool(db, size=POOL_SIZE, busy_timeout=BUSY_TIMEOUT)
+    # covers waiting for a pooled connection, the queries and the commit
+    with instrumentation.timed('db_cursor_seconds', db=db), pool.connection() as conn:
         # cursor allows you to execute sql code
         cur = conn.cursor()
-        yield cur
-        # commit saves changes to the database
-        conn.commit()
-    finally:
-        # finally closing connection
-        conn.close()
-
-# method for saving data_value
-def add_data(data):
-    with cursor() as cur:
-        # save current time to date
-        date = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            yield cur
+            # commit saves changes to the database
+            conn.commit()
+        except sq.Error:
+            conn.rollback()
+            raise
+        finally:
+            # the connection itself goes back to the pool, only the cursor is closed
+            cur.close()
+
+# writes buffered datapoints, started on first use when [INGEST] buffered is on
+_batch = None
+
+def _batch_writer():
+    global _batch
+    if _batch is None:
+        _batch = BatchWriter(INSERT_DATA, cursor,
+            batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL)
+    return _batch
+
+instrumentation.gauge('db_batch_pending', lambda: len(_batch) if _batch is not None else 0)
+
+# writes every buffered datapoint now
+def flush():
+    if _batch is not None:
+        _batch.flush()
+
+# flushes buffered datapoints and closes every pooled connection,
+# called when the bot shuts down
+def close():
+    global _batch
+    if _batch is not None:
+        _batch.close()
+        _batch = None
+    db_pool.close_all()
+
+INSERT_DATA = 'INSERT INTO data_table (user_id, metric, ts, value) VALUES (?, ?, ?, ?)'
+
+# data as a float, raises ValueError if it is not a finite number
+def _value(data):
+    value = float(data)
+    if value != value or value in (float('inf'), float('-inf')):
+        raise ValueError(f"not a finite number: {data!r}")
+    return value
+
+# builds a data_table row, raises ValueError if data is not a number
+def _datarow(data, user_id, metric):
+    # save current time as unix epoch seconds
+    return (user_id, metric, int(time.time()), _value(data))
+
+# method for queueing data_value in the batch writer, returns a Future
+# that resolves once the value is committed
+def queue_data(data, user_id, metric='data'):
+    return _batch_writer().add(_datarow(data, user_id, metric))
+
+# method for saving data_value of the user
+def add_data(data, user_id, metric='data'):
+    row = _datarow(data, user_id, metric)
+    if BUFFERED:
+        fut = _batch_writer().add(row)
+        if DURABILITY == 'commit':
+            fut.result()
+        return
+    with cursor() as cur:
         # executing command INSERT INTO for saving new data
-        cur.execute('INSERT INTO data_table values(?, ?)', (date, data))
+        cur.execute(INSERT_DATA, row)
 
-# gets selected data from table data_table and returns it 
-# TODO: expand on this to select data from different tables in the future
-def getdatapoint():
+# gets the user's datapoints of one metric as (date, value) rows, oldest first
+def getdatapoint(user_id, metric='data'):
     with cursor() as cur:
-        cur.execute('SELECT date, data from data_table')
+        cur.execute("SELECT datetime(ts, 'unixepoch', 'localtime'), value FROM data_table "
+            'WHERE user_id=? AND metric=? ORDER BY ts', (user_id, metric))
         rows = cur.fetchall()
-    return rows
\ No newline at end of file
+    return rows
+
+# the query methods below return (ts, value) rows with ts in epoch seconds,
+# all of them are answered from the (user_id, metric, ts) index
+
+# datapoints with start <= ts < end, oldest first; None leaves a side open
+def get_range(user_id, metric='data', start=None, end=None):
+    sql = 'SELECT ts, value FROM data_table WHERE user_id=? AND metric=?'
+    args = [user_id, metric]
+    if start is not None:
+        sql += ' AND ts >= ?'
+        args.append(int(start))
+    if end is not None:
+        sql += ' AND ts < ?'
+        args.append(int(end))
+    with cursor() as cur:
+        cur.execute(sql + ' ORDER BY ts', args)
+        rows = cur.fetchall()
+    return rows
+
+# the n newest datapoints, oldest first
+def get_latest(user_id, metric='data', n=100):
+    with cursor() as cur:
+        cur.execute('SELECT ts, value FROM data_table WHERE user_id=? AND metric=? '
+            'ORDER BY ts DESC LIMIT ?', (user_id, metric, n))
+        rows = cur.fetchall()
+    rows.reverse()
+    return rows
+
+# rollup resolutions from coarsest to finest, see initdatabase._data_rollup_v2
+ROLLUP_RESOLUTIONS = (86400, 3600, 60)
+
+# gets the user's metric for plotting as (ts, value) rows, oldest first.
+# Picks the coarsest rollup resolution that still gives at least one bucket
+# per two pixels of width over the range (a line chart can't show more
+# detail than that) and reads bucket means from data_rollup; short ranges
+# fall back to the raw datapoints.
+def get_series(user_id, metric='data', start=None, end=None, width=640):
+    with cursor() as cur:
+        if start is None or end is None:
+            # both ends of the index range, no scan needed
+            cur.execute('SELECT min(ts), max(ts) FROM data_table WHERE user_id=? AND metric=?',
+                (user_id, metric))
+            first, last = cur.fetchone()
+            if first is None:
+                return []
+            start = first if start is None else start
+            end = last + 1 if end is None else end
+
+        for resolution in ROLLUP_RESOLUTIONS:
+            if (end - start) / resolution >= width / 2:
+                cur.execute('SELECT bucket, sum_value / count FROM data_rollup '
+                    'WHERE user_id=? AND metric=? AND resolution=? '
+                    'AND bucket >= ? AND bucket < ? ORDER BY bucket',
+                    (user_id, metric, resolution, start - start % resolution, end))
+                return cur.fetchall()
+
+        cur.execute('SELECT ts, value FROM data_table '
+            'WHERE user_id=? AND metric=? AND ts >= ? AND ts < ? ORDER BY ts',
+            (user_id, metric, start, end))
+        return cur.fetchall()
+
+# marks how far the user's metric has been written: (row count, newest day).
+# Rows are only ever appended, so it changes with every new row. Read from
+# the daily rollups, a few hundred rows per year of data.
+def high_water(user_id, metric='data'):
+    with cursor() as cur:
+        cur.execute('SELECT coalesce(sum(count), 0), max(bucket) FROM data_rollup '
+            'WHERE user_id=? AND metric=? AND resolution=86400', (user_id, metric))
+        row = cur.fetchone()
+    return tuple(row)
+
+# every datapoint of the user as (metric, ts, value) rows
+def get_user_data(user_id):
+    with cursor() as cur:
+        cur.execute('SELECT metric, ts, value FROM data_table WHERE user_id=? '
+            'ORDER BY metric, ts', (user_id,))
+        rows = cur.fetchall()
+    return rows
+
+# names of the metrics the user has stored
+def get_metrics(user_id):
+    with cursor() as cur:
+        cur.execute('SELECT DISTINCT metric FROM data_table WHERE user_id=?', (user_id,))
+        rows = [row[0] for row in cur.fetchall()]
+    return rows
+
+
+########## conversationbot tables ##########
+
+# users and hrv tables live in their own database, see initdatabase.initbotdb
+BOT_DATABASE = 'database.db'
+
+# columns the conversations are allowed to fill in
+USER_COLUMNS = ('gender', 'photo', 'location', 'bio')
+HRV_COLUMNS = ('summary', 'graphs', 'details',
+    'summary_file_id', 'graphs_file_id', 'details_file_id')
+
+# logs the row a write just changed, for a sampled share of writes only.
+# Runs on the writing cursor so it sees the row as it will be committed.
+def _trace(cur, table, row_id):
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return
+    row = cur.execute(f'SELECT * FROM {table} WHERE id=?', (row_id,)).fetchone()
+    logger.info("%s row %s: %s", table, row_id, row)
+
+# method for starting a new users row, returns its id
+def add_user(user_id, name):
+    with cursor(BOT_DATABASE) as cur:
+        cur.execute('INSERT INTO users (user_id, name) VALUES (?, ?)', (user_id, name))
+        _trace(cur, 'users', cur.lastrowid)
+        return cur.lastrowid
+
+# sets one column of a users row, row_id is the id returned by add_user
+def update_user(row_id, column, value):
+    if column not in USER_COLUMNS:
+        raise ValueError(f"unknown users column: {column}")
+    with cursor(BOT_DATABASE) as cur:
+        cur.execute(f'UPDATE users SET {column}=? WHERE id=?', (value, row_id))
+        _trace(cur, 'users', row_id)
+
+# method for starting a new hrv row, returns its id
+def add_hrv(user_id, name):
+    with cursor(BOT_DATABASE) as cur:
+        cur.execute('INSERT INTO hrv (user_id, name) VALUES (?, ?)', (user_id, name))
+        _trace(cur, 'hrv', cur.lastrowid)
+        return cur.lastrowid
+
+# sets one column (photo path) of an hrv row, row_id is the id returned by add_hrv
+def update_hrv(row_id, column, value):
+    if column not in HRV_COLUMNS:
+        raise ValueError(f"unknown hrv column: {column}")
+    # a new photo makes the telegram file_id of the old one stale
+    stale = '' if column.endswith('_file_id') else f', {column}_file_id=NULL'
+    with cursor(BOT_DATABASE) as cur:
+        cur.execute(f'UPDATE hrv SET {column}=?{stale} WHERE id=?', (value, row_id))
+        _trace(cur, 'hrv', row_id)
+
+# id of the user's newest row in users or hrv, None if there is none
+def latest_row(table, user_id):
+    if table not in ('users', 'hrv'):
+        raise ValueError(f"unknown table: {table}")
+    with cursor(BOT_DATABASE) as cur:
+        cur.execute(f'SELECT id FROM {table} WHERE user_id=? ORDER BY id DESC LIMIT 1', (user_id,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+# gets the user's newest hrv row as (id, summary, graphs, details,
+# summary_file_id, graphs_file_id, details_file_id), None if there is none
+def get_hrv(user_id):
+    with cursor(BOT_DATABASE) as cur:
+        cur.execute('SELECT id, summary, graphs, details, '
+            'summary_file_id, graphs_file_id, details_file_id FROM hrv WHERE user_id=? '
+            'ORDER BY id DESC LIMIT 1', (user_id,))
+        row = cur.fetchone()
+    return row
+
+
+########## export ##########
+
+# rows read per fetchmany while exporting
+EXPORT_CHUNK = cfg.getint('EXPORT', 'chunk_size', fallback=5000)
+# gzip or zstd (needs the zstandard package, falls back to gzip without it)
+EXPORT_COMPRESSION = cfg.get('EXPORT', 'compression', fallback='gzip')
+# exports bigger than this are spooled to a temporary file instead of memory
+EXPORT_SPOOL = cfg.getint('EXPORT', 'spool_mb', fallback=8) * 1024 * 1024
+
+EXPORT_FORMATS = ('csv', 'columnar')
+# series names export() takes besides a metric
+EXPORT_ALL = 'all'
+EXPORT_HRV = 'hrv graphs'
+
+COLUMNAR_MAGIC = b'EECOL1\n'
+
+# a writer that compresses into out, closing it finishes the stream but
+# leaves out open
+def _compressor(out, compression):
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            logger.warning("zstandard is not installed, exporting with gzip")
+        else:
+            return zstandard.ZstdCompressor().stream_writer(out, closefd=False), '.zst'
+    return gzip.GzipFile(fileobj=out, mode='wb'), '.gz'
+
+# yields the rows of a query fetchmany(EXPORT_CHUNK) at a time, so only one
+# chunk is in memory however long the history is
+def _chunks(cur, sql, args):
+    cur.execute(sql, args)
+    while True:
+        rows = cur.fetchmany(EXPORT_CHUNK)
+        if not rows:
+            return
+        yield rows
+
+# One frame of the columnar format: a little-endian uint32 header length,
+# a JSON header naming the columns, their numpy dtypes and the row count,
+# then each column as a packed array. Read back with numpy.frombuffer.
+def _frame(header, columns):
+    header['rows'] = len(columns[0][2])
+    header['columns'] = [[name, dtype] for name, dtype, _ in columns]
+    encoded = json.dumps(header).encode()
+    body = b''.join(numpy.asarray(values, dtype=dtype).tobytes() for _, dtype, values in columns)
+    return struct.pack('<I', len(encoded)) + encoded + body
+
+def _export_series(cur, writer, fmt, user_id, series):
+    sql = 'SELECT metric, ts, value FROM data_table WHERE user_id=?'
+    args = (user_id,)
+    if series != EXPORT_ALL:
+        sql += ' AND metric=?'
+        args += (series,)
+    sql += ' ORDER BY metric, ts'
+    if fmt == 'csv':
+        writer.write(b'metric,ts,time,value\n')
+    for rows in _chunks(cur, sql, args):
+        if fmt == 'csv':
+            text = io.StringIO()
+            csv.writer(text, lineterminator='\n').writerows(
+                (metric, ts, time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ts)), value)
+                for metric, ts, value in rows)
+            writer.write(text.getvalue().encode())
+            continue
+        # one frame per metric within the chunk
+        start = 0
+        for end in range(1, len(rows) + 1):
+            if end == len(rows) or rows[end][0] != rows[start][0]:
+                part = rows[start:end]
+                writer.write(_frame({'series': part[0][0]}, [
+                    ('ts', '<i8', [row[1] for row in part]),
+                    ('value', '<f8', [row[2] for row in part]),
+                ]))
+                start = end
+
+def _export_graphs(cur, writer, fmt, user_id):
+    sql = ('SELECT title, x_unit, y_unit, scale, data FROM hrv_graphs '
+        'WHERE user_id=? ORDER BY title')
+    if fmt == 'csv':
+        writer.write(b'title,x_unit,y_unit,scale,index,value\n')
+    for rows in _chunks(cur, sql, (user_id,)):
+        for title, x_unit, y_unit, scale, data in rows:
+            values = numpy.frombuffer(data, dtype='<f4')
+            if fmt == 'csv':
+                text = io.StringIO()
+                csv.writer(text, lineterminator='\n').writerows(
+                    (title, x_unit, y_unit, scale, index, float(value))
+                    for index, value in enumerate(values))
+                writer.write(text.getvalue().encode())
+            else:
+                writer.write(_frame(
+                    {'graph': title, 'x_unit': x_unit, 'y_unit': y_unit, 'scale': scale},
+                    [('data', '<f4', values)]))
+
+# exports the user's history of one metric, every metric (EXPORT_ALL) or the
+# raw HRV graph arrays (EXPORT_HRV) as compressed csv or columnar data.
+# Returns (file, filename) with the file positioned at its start; it is kept
+# in memory up to EXPORT_SPOOL bytes and spills to disk beyond that.
+def export(user_id, series='data', fmt='csv', compression=EXPORT_COMPRESSION):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unknown export format {fmt}")
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL)
+    writer, suffix = _compressor(out, compression)
+    if fmt == 'columnar':
+        writer.write(COLUMNAR_MAGIC)
+    if series == EXPORT_HRV:
+        with cursor(BOT_DATABASE) as cur:
+            _export_graphs(cur, writer, fmt, user_id)
+    else:
+        with cursor() as cur:
+            _export_series(cur, writer, fmt, user_id, series)
+    writer.close()
+    out.seek(0)
+    name = series.replace(' ', '_')
+    extension = '.csv' if fmt == 'csv' else '.eecol'
+    return out, f"{user_id}-{name}{extension}{suffix}"
+
+
+########## import ##########
+
+# rows written per executemany and transaction while importing
+IMPORT_CHUNK = cfg.getint('IMPORT', 'chunk_size', fallback=5000)
+# invalid rows reported back (all of them are counted)
+IMPORT_ERRORS = 5
+MAX_METRIC = 64
+# imported timestamps must lie between the epoch and the end of year 9999
+MAX_TS = 253402300799
+
+# epoch seconds of an epoch number or ISO 8601 string, naive times are UTC
+def _timestamp(data):
+    if isinstance(data, (int, float)):
+        return int(data)
+    try:
+        return int(float(data))
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(data.strip().replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+# builds a data_table row from an imported record (a dict with value, ts or
+# time, and optionally metric), raises ValueError if it isn't valid
+def _importrow(record, user_id):
+    if not isinstance(record, dict):
+        raise ValueError("not an object")
+    metric = record.get('metric') or 'data'
+    if not isinstance(metric, str) or len(metric) > MAX_METRIC:
+        raise ValueError(f"bad metric {metric!r}")
+    moment = record.get('ts') if record.get('ts') not in (None, '') else record.get('time')
+    if moment in (None, ''):
+        raise ValueError("no ts or time")
+    ts = _timestamp(moment)
+    if not 0 <= ts <= MAX_TS:
+        raise ValueError(f"timestamp out of range: {moment!r}")
+    return (user_id, metric, ts, _value(record.get('value')))
+
+# characters read to tell CSV, a JSON array and JSON lines apart
+IMPORT_PEEK = 4096
+# a JSON array element that doesn't decode within this many characters is broken
+MAX_RECORD = 1 << 20
+
+# elements of a JSON array, decoded one at a time; buffer is what was
+# already read from text
+def _json_array(text, buffer):
+    decoder = json.JSONDecoder()
+    position = buffer.index('[') + 1
+    while True:
+        # skip whitespace and the commas between elements
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if buffer[position:position + 1] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if len(buffer) - position > MAX_RECORD:
+                raise ValueError("broken JSON array element") from None
+            chunk = text.read(1 << 16)
+            if not chunk:
+                raise ValueError("truncated JSON document") from None
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield record
+        position = end
+
+# lines of the document, starting with the peeked characters
+def _lines(text, peek):
+    # finish the peeked line so both parts split on line boundaries
+    head = peek + text.readline() if peek and peek[-1] not in '\r\n' else peek
+    return itertools.chain(io.StringIO(head, newline=''), text)
+
+# opens an uploaded document as text, gzip compressed ones included
+def _import_text(file):
+    if file.read(2) == b'\x1f\x8b':
+        file.seek(0)
+        file = gzip.GzipFile(fileobj=file, mode='rb')
+    else:
+        file.seek(0)
+    return io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+
+# (number, record) pairs of a CSV (metric, ts or time, value columns, as
+# written by export), JSON array or JSON lines document, and the function
+# turning a record into a dict. JSON lines are decoded one line at a time,
+# so a broken line only rejects itself.
+def _import_records(text):
+    try:
+        peek = text.read(IMPORT_PEEK)
+    except (ValueError, OSError, EOFError, zlib.error) as err:
+        raise ValueError(f"unreadable document: {err}") from None
+    start = peek.lstrip()[:1]
+    if start == '[':
+        return enumerate(_json_array(text, peek), 1), lambda record: record
+    if start == '{':
+        lines = ((number, line) for number, line in enumerate(_lines(text, peek), 1) if line.strip())
+        return lines, json.loads
+    # the header is record 1
+    return enumerate(csv.DictReader(_lines(text, peek)), 2), lambda record: record
+
+# yields the data_table rows of an uploaded document in lists of up to
+# IMPORT_CHUNK rows, parsing and validating records as they are read.
+# Invalid records are skipped and counted in result (a dict made by
+# import_result); raises ValueError if the document can't be read at all.
+def import_chunks(user_id, file, result):
+    records, decode = _import_records(_import_text(file))
+    chunk = []
+    try:
+        for number, record in records:
+            try:
+                row = _importrow(decode(record), user_id)
+            except (ValueError, TypeError, OverflowError) as err:
+                result['rejected'] += 1
+                if len(result['errors']) < IMPORT_ERRORS:
+                    result['errors'].append(f"record {number}: {err}")
+                continue
+            chunk.append(row)
+            result['metrics'].add(row[1])
+            if len(chunk) >= IMPORT_CHUNK:
+                yield chunk
+                chunk = []
+    except (ValueError, csv.Error, OSError, EOFError, zlib.error) as err:
+        # the document itself is broken (bad encoding, cut off), keep what
+        # was read up to there
+        result['errors'].append(f"stopped reading: {err}")
+    if chunk:
+        yield chunk
+
+def import_result():
+    return {'rows': 0, 'rejected': 0, 'errors': [], 'metrics': set()}
+
+# writes one chunk of import_chunks in a transaction
+def write_import(chunk):
+    with cursor() as cur:
+        cur.executemany(INSERT_DATA, chunk)
+    return len(chunk)
+
+# loads datapoints from an uploaded CSV or JSON document into data_table.
+# progress(rows, seconds) is called after every chunk. Returns a dict with
+# rows, rejected, errors (the first few), metrics and seconds.
+def import_data(user_id, file, progress=None):
+    started = time.perf_counter()
+    result = import_result()
+    for chunk in import_chunks(user_id, file, result):
+        result['rows'] += write_import(chunk)
+        if progress is not None:
+            progress(result['rows'], time.perf_counter() - started)
+    result['seconds'] = time.perf_counter() - started
+    return result
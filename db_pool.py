@@ -0,0 +1,149 @@
+import sqlite3 as sq
+import logging
+import queue
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+# ConnectionPool keeps a fixed number of long-lived sqlite connections open
+# so handlers don't pay for connect/teardown (and re-reading the schema) on
+# every call. Connections are handed out through a thread-safe queue, which
+# makes them safe to share between the asyncio handlers and any executor
+# threads doing database work for them.
+class ConnectionPool:
+    """Pool of reusable sqlite connections to a single database file."""
+
+    def __init__(self, db, size=4, busy_timeout=5000, acquire_timeout=10.0, health_interval=30.0):
+        self.db = db
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.acquire_timeout = acquire_timeout
+        # connections idle for longer than this are pinged before reuse
+        self.health_interval = health_interval
+        # LIFO so the most recently used (warmest) connection is reused first
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+    def _connect(self):
+        # check_same_thread=False: a connection may be released by one thread
+        # and picked up by another, but it is never used by two at once
+        conn = sq.connect(self.db, timeout=self.busy_timeout / 1000, check_same_thread=False)
+        conn.execute("PRAGMA encoding='UTF-8'")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        logger.debug("Opened connection %d/%d to %s", self._created, self.size, self.db)
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.close()
+        except sq.Error:
+            pass
+
+    @staticmethod
+    def healthy(conn):
+        """Returns True if the connection still answers a trivial query."""
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sq.Error:
+            return False
+
+    def acquire(self):
+        """Takes a connection from the pool, opening a new one if there is room."""
+        while True:
+            if self._closed:
+                raise RuntimeError(f"connection pool for {self.db} is closed")
+            try:
+                conn, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    room = self._created < self.size
+                    if room:
+                        self._created += 1
+                if room:
+                    try:
+                        return self._connect()
+                    except sq.Error:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                try:
+                    conn, released_at = self._idle.get(timeout=self.acquire_timeout)
+                except queue.Empty:
+                    raise TimeoutError(
+                        f"no sqlite connection to {self.db} available after {self.acquire_timeout}s"
+                    ) from None
+
+            if time.monotonic() - released_at < self.health_interval or self.healthy(conn):
+                return conn
+            logger.warning("Dropping broken connection to %s", self.db)
+            self._discard(conn)
+
+    def release(self, conn, broken=False):
+        """Gives a connection back to the pool (or closes it if it is broken)."""
+        if not broken:
+            try:
+                # never hand over a connection with an open transaction
+                if conn.in_transaction:
+                    conn.rollback()
+            except sq.Error:
+                broken = True
+        if broken or self._closed:
+            self._discard(conn)
+        else:
+            self._idle.put_nowait((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except sq.Error:
+            # most errors (bad SQL, "database is locked") leave the connection
+            # usable, but disk or handle errors may not
+            broken = not self.healthy(conn)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self):
+        """Closes all idle connections; busy ones are closed on release."""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+# one shared pool per database file
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db, **kwargs):
+    """Returns the shared pool for db, creating it with kwargs on first use."""
+    with _pools_lock:
+        pool = _pools.get(db)
+        if pool is None or pool._closed:
+            pool = _pools[db] = ConnectionPool(db, **kwargs)
+        return pool
+
+
+def close_all():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
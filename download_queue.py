@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+# using separate configuration and parser
+from configparser import ConfigParser
+
+import blob_store
+import db_async
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+# row update functions of the tables photos are recorded in
+UPDATERS = {'users': db_async.update_user, 'hrv': db_async.update_hrv}
+
+
+# returns the smallest PhotoSize whose shorter side is at least min_side
+# pixels, the largest one if none is that big. Telegram lists the sizes of
+# a photo from small to large.
+def pick_size(photos, min_side):
+    for size in photos:
+        if min(size.width, size.height) >= min_side:
+            return size
+    return photos[-1]
+
+
+# DownloadQueue saves photos in the background so a handler can answer the
+# user right away. A fixed number of worker tasks take jobs off a bounded
+# queue, download the file into the blob store and only then write its path
+# into the row, so a row column is set once the photo is really on disk.
+# When the queue is full submit() waits, which slows a flood of photos down
+# instead of piling up downloads.
+class DownloadQueue:
+    """Bounded pool of background photo downloads."""
+
+    def __init__(self, workers=4, max_queue=100):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue = None
+        self._tasks = []
+        self.done = 0
+        self.failed = 0
+
+    def __len__(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _start(self):
+        # created on first use so they bind to the running event loop
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._work(), name=f"download-{i}")
+            for i in range(self.workers)]
+
+    async def submit(self, photo, table, row_id, column):
+        """Queues photo (a PhotoSize) to be saved into table.column of row_id."""
+        if self._queue is None:
+            self._start()
+        await self._queue.put((photo, table, row_id, column))
+
+    async def _download(self, photo, table, row_id, column):
+        photo_file = await photo.get_file()
+        path = await blob_store.store(photo_file)
+        await UPDATERS[table](row_id, column, path)
+        logger.info("Saved %s %s of row %s: %s", table, column, row_id, path)
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._download(*job)
+                self.done += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Failed to save %s %s of row %s", job[1], job[3], job[2])
+            finally:
+                self._queue.task_done()
+
+    async def close(self, timeout=30.0):
+        """Waits (up to timeout seconds) for queued downloads, then stops the workers."""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d unfinished photo downloads", len(self))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._queue, self._tasks = None, []
+
+
+# shared queue, see [DOWNLOADS] in env-example.cfg
+queue = DownloadQueue(
+    workers=cfg.getint('DOWNLOADS', 'workers', fallback=4),
+    max_queue=cfg.getint('DOWNLOADS', 'max_queue', fallback=100),
+)
+instrumentation.gauge('download_queue_depth', lambda: len(queue))
+instrumentation.gauge('downloads_failed', lambda: queue.failed)
+
+# shorter side in pixels a saved photo should have at least
+MIN_SIDE = cfg.getint('DOWNLOADS', 'min_resolution', fallback=1080)
+
+async def submit(photos, table, row_id, column):
+    """Queues the best fitting size of a message's photo."""
+    await queue.submit(pick_size(photos, MIN_SIDE), table, row_id, column)
+
+async def close():
+    await queue.close()
@@ -34,6 +34,9 @@ from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandl
 # using separate configuration and parser
 from configparser import ConfigParser
 
+import webhook
+import instrumentation
+
 # configparser
 cfg = ConfigParser()
 cfg.read('env.cfg')
@@ -66,8 +69,8 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(update.message.text)
 
 
-def main() -> None:
-    """Start the bot."""
+def build_application() -> Application:
+    """Creates the bot's Application with all handlers added."""
     # Create the Application and pass it your bot's token.
     application = Application.builder().token(cfg['TELEGRAM']['token']).build()
 
@@ -78,8 +81,17 @@ def main() -> None:
     # on non command i.e message - echo the message on Telegram
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    # handler latencies and errors, served on /metrics when [METRICS] is enabled
+    instrumentation.install(application)
+
+    return application
+
+
+def main() -> None:
+    """Start the bot."""
+    # Run the bot until the user presses Ctrl-C, by long polling or as
+    # webhook workers when [WEBHOOK] is enabled
+    webhook.run(build_application)
 
 
 if __name__ == "__main__":
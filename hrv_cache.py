@@ -0,0 +1,128 @@
+import functools
+import hashlib
+import json
+import logging
+import time
+import zlib
+
+from collections import OrderedDict
+# using separate configuration and parser
+from configparser import ConfigParser
+
+import initdatabase
+import db_handler
+import db_async
+import http_client
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+ECG_URL = cfg.get('HTTP', 'ecg_url', fallback='https://ecg4everybody.com/service/getdata.php')
+
+# cache settings, see [CACHE] in env-example.cfg
+CACHE_DATABASE = 'cache.db'
+TTL = cfg.getint('CACHE', 'ttl', fallback=7 * 24 * 3600)
+MAX_BYTES = cfg.getint('CACHE', 'max_mb', fallback=100) * 1024 * 1024
+MEMORY_ENTRIES = cfg.getint('CACHE', 'memory_entries', fallback=64)
+
+# Payloads fetched from ecg4everybody are cached on disk in cache.db, keyed
+# on the link's i= token. The zlib compressed JSON body is stored once per
+# sha256 of its content, so tokens returning the same data share one copy.
+# A small in-process LRU of parsed payloads sits in front of the disk cache.
+initdatabase.initcachedb(CACHE_DATABASE)
+
+_memory = OrderedDict()
+_stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+# hit/miss counters since the bot started
+def stats():
+    return dict(_stats, memory_entries=len(_memory))
+
+for _name in _stats:
+    instrumentation.gauge('hrv_cache_' + _name, functools.partial(_stats.get, _name))
+
+# a usable payload has a list of graph arrays, ecg4everybody answers unknown
+# or broken links with 200 and an error or empty body
+def _valid(payload):
+    return isinstance(payload, dict) and isinstance(payload.get('graph_arrays'), list)
+
+def _remember(token, payload, fetched_at):
+    _memory[token] = (fetched_at, payload)
+    _memory.move_to_end(token)
+    while len(_memory) > MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+# reads the token's (payload, fetched_at) from the disk cache, None if
+# missing or expired
+def _load(token):
+    now = int(time.time())
+    with db_handler.cursor(CACHE_DATABASE) as cur:
+        cur.execute('SELECT p.body, t.fetched_at FROM hrv_tokens t JOIN hrv_payloads p USING (sha256) '
+            'WHERE t.token=? AND t.fetched_at > ?', (token, now - TTL))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        cur.execute('UPDATE hrv_tokens SET last_used=? WHERE token=?', (now, token))
+    return json.loads(zlib.decompress(row[0])), row[1]
+
+# stores a fetched body and evicts expired or least recently used entries
+def _store(token, body):
+    now = int(time.time())
+    sha = hashlib.sha256(body).hexdigest()
+    packed = zlib.compress(body)
+    with db_handler.cursor(CACHE_DATABASE) as cur:
+        cur.execute('INSERT OR IGNORE INTO hrv_payloads (sha256, size, body) VALUES (?, ?, ?)',
+            (sha, len(packed), packed))
+        cur.execute('INSERT OR REPLACE INTO hrv_tokens (token, sha256, fetched_at, last_used) '
+            'VALUES (?, ?, ?, ?)', (token, sha, now, now))
+        _evict(cur, now)
+
+def _evict(cur, now):
+    cur.execute('DELETE FROM hrv_tokens WHERE fetched_at <= ?', (now - TTL,))
+    total = cur.execute('SELECT coalesce(sum(size), 0) FROM hrv_payloads').fetchone()[0]
+    if total > MAX_BYTES:
+        # drop least recently used tokens until their payloads fit again
+        over = total - MAX_BYTES
+        for token, size in cur.execute('SELECT t.token, p.size FROM hrv_tokens t '
+                'JOIN hrv_payloads p USING (sha256) ORDER BY t.last_used').fetchall():
+            if over <= 0:
+                break
+            cur.execute('DELETE FROM hrv_tokens WHERE token=?', (token,))
+            over -= size
+    cur.execute('DELETE FROM hrv_payloads WHERE sha256 NOT IN (SELECT sha256 FROM hrv_tokens)')
+
+async def fetch(token):
+    """Returns the parsed ecg4everybody payload for the i= token.
+
+    Served from memory or disk when cached, fetched otherwise. The returned
+    dict is shared with the cache, don't modify it. Raises ValueError if
+    ecg4everybody doesn't return graph data for the token.
+    """
+    entry = _memory.get(token)
+    if entry is not None:
+        if entry[0] > time.time() - TTL:
+            _memory.move_to_end(token)
+            _stats['memory_hits'] += 1
+            return entry[1]
+        del _memory[token]
+
+    loaded = await db_async.write(_load, token)
+    if loaded is not None and _valid(loaded[0]):
+        _stats['disk_hits'] += 1
+        payload, fetched_at = loaded
+    else:
+        _stats['misses'] += 1
+        resp = await http_client.post(ECG_URL, data={'i': token})
+        payload = resp.json()
+        # error or empty answers are not cached, they'd stick for ttl
+        if not _valid(payload):
+            raise ValueError(f"no graph data for token {token}")
+        fetched_at = int(time.time())
+        await db_async.write(_store, token, resp.content)
+    _remember(token, payload, fetched_at)
+    logger.debug("hrv cache %s", _stats)
+    return payload
@@ -0,0 +1,185 @@
+import json
+import logging
+import multiprocessing
+import re
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+import db_handler
+import hrv_store
+
+logger = logging.getLogger(__name__)
+
+# HRV metrics computed from the RR interval series of a stored payload
+# (see hrv_store). Time domain metrics come straight from the intervals,
+# frequency domain ones from the tachogram resampled at RESAMPLE_HZ, with
+# both a Welch periodogram and an autoregressive (Yule-Walker) spectrum.
+# Results are cached per payload in the hrv_metrics table.
+
+# graph titles that hold RR intervals
+RR_TITLE = re.compile(r'\b(rr|nn|ibi|tachogram)\b', re.IGNORECASE)
+
+RESAMPLE_HZ = 4.0
+# frequency bands in Hz
+LF_BAND = (0.04, 0.15)
+HF_BAND = (0.15, 0.40)
+WELCH_SEGMENT = 256
+AR_ORDER = 16
+
+# returns the RR intervals in milliseconds from the user's graphs, None if
+# the payload has no RR series
+def rr_intervals(graphs):
+    for graph in graphs:
+        if RR_TITLE.search(graph['title'] or ""):
+            rr = numpy.asarray(graph['data'], dtype=numpy.float64)
+            if graph['scale']:
+                rr = rr / graph['scale']
+            rr = rr[numpy.isfinite(rr) & (rr > 0)]
+            if len(rr) and numpy.median(rr) < 10:
+                # given in seconds
+                rr = rr * 1000
+            return rr
+    return None
+
+def time_domain(rr):
+    diff = numpy.diff(rr)
+    return {
+        'mean_rr': float(rr.mean()),
+        'mean_hr': float(60000 / rr.mean()),
+        'sdnn': float(rr.std(ddof=1)) if len(rr) > 1 else 0.0,
+        'rmssd': float(numpy.sqrt(numpy.mean(diff ** 2))) if len(diff) else 0.0,
+        'pnn50': float(100 * numpy.mean(numpy.abs(diff) > 50)) if len(diff) else 0.0,
+    }
+
+# evenly sampled, mean removed tachogram
+def _resample(rr):
+    beats = numpy.cumsum(rr) / 1000
+    grid = numpy.arange(beats[0], beats[-1], 1 / RESAMPLE_HZ)
+    signal = numpy.interp(grid, beats, rr)
+    return signal - signal.mean()
+
+def _band_power(freqs, psd, band):
+    mask = (freqs >= band[0]) & (freqs < band[1])
+    if not mask.any():
+        return 0.0
+    return float(psd[mask].sum() * (freqs[1] - freqs[0]))
+
+def _bands(freqs, psd):
+    lf = _band_power(freqs, psd, LF_BAND)
+    hf = _band_power(freqs, psd, HF_BAND)
+    return {'lf': lf, 'hf': hf, 'lf_hf': lf / hf if hf else None}
+
+# Welch periodogram: averaged Hann windowed segments with 50% overlap
+def welch(signal, fs=RESAMPLE_HZ, segment=WELCH_SEGMENT):
+    segment = min(segment, len(signal))
+    step = segment // 2 or 1
+    window = numpy.hanning(segment)
+    starts = range(0, len(signal) - segment + 1, step)
+    frames = numpy.stack([signal[s:s + segment] for s in starts]) * window
+    spectrum = numpy.abs(numpy.fft.rfft(frames, axis=1)) ** 2
+    psd = spectrum.mean(axis=0) / (fs * (window ** 2).sum())
+    # one sided spectrum, double everything except DC and Nyquist
+    psd[1:-1] *= 2
+    return numpy.fft.rfftfreq(segment, 1 / fs), psd
+
+# autoregressive spectrum, Yule-Walker coefficients via Levinson-Durbin
+def ar_psd(signal, fs=RESAMPLE_HZ, order=AR_ORDER, points=512):
+    n = len(signal)
+    acf = numpy.correlate(signal, signal, 'full')[n - 1:n + order] / n
+    a = numpy.zeros(order + 1)
+    a[0] = 1.0
+    error = acf[0]
+    for k in range(1, order + 1):
+        reflection = -(acf[k] + a[1:k] @ acf[k - 1:0:-1]) / error
+        a[1:k + 1] = a[1:k + 1] + reflection * numpy.concatenate((a[k - 1:0:-1], [1.0]))
+        error *= 1 - reflection ** 2
+    freqs = numpy.linspace(0, fs / 2, points)
+    response = numpy.exp(-2j * numpy.pi * numpy.outer(freqs / fs, numpy.arange(order + 1))) @ a
+    return freqs, 2 * error / (fs * numpy.abs(response) ** 2)
+
+# every metric of one RR series, frequency domain ones need about a minute
+# of data or they are left out
+def compute(rr):
+    metrics = time_domain(rr)
+    signal = _resample(rr)
+    if len(signal) >= 2 * AR_ORDER and len(signal) >= RESAMPLE_HZ * 60:
+        metrics['welch'] = _bands(*welch(signal))
+        metrics['ar'] = _bands(*ar_psd(signal))
+    return metrics
+
+# gets the metrics of the user's stored payload, computing and caching them
+# if the payload changed since they were last computed. None if the user
+# has no RR series stored.
+def user_metrics(user_id):
+    graphs = hrv_store.load_graphs(user_id)
+    if not graphs:
+        return None
+    token = graphs[0]['token']
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('SELECT metrics FROM hrv_metrics WHERE user_id=? AND token IS ?', (user_id, token))
+        row = cur.fetchone()
+    if row is not None:
+        return json.loads(row[0])
+
+    rr = rr_intervals(graphs)
+    if rr is None or len(rr) < 2:
+        return None
+    metrics = compute(rr)
+    save_metrics(user_id, token, metrics)
+    return metrics
+
+def save_metrics(user_id, token, metrics):
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('INSERT OR REPLACE INTO hrv_metrics (user_id, token, metrics, computed_at) '
+            'VALUES (?, ?, ?, ?)', (user_id, token, json.dumps(metrics), int(time.time())))
+
+# the metrics as a telegram message
+def format_metrics(metrics):
+    lines = [
+        f"Mean RR: {metrics['mean_rr']:.0f} ms",
+        f"Mean HR: {metrics['mean_hr']:.0f} bpm",
+        f"SDNN: {metrics['sdnn']:.1f} ms",
+        f"RMSSD: {metrics['rmssd']:.1f} ms",
+        f"pNN50: {metrics['pnn50']:.1f} %",
+    ]
+    for name, label in (('welch', 'Welch'), ('ar', 'AR')):
+        if name in metrics:
+            bands = metrics[name]
+            ratio = f"{bands['lf_hf']:.2f}" if bands['lf_hf'] is not None else "-"
+            lines.append(f"{label} LF: {bands['lf']:.0f} ms², HF: {bands['hf']:.0f} ms², LF/HF: {ratio}")
+    return "\n".join(lines)
+
+
+########## BATCH MODE ##########
+
+# worker process part of recompute_all, returns (user_id, token, metrics)
+def _recompute(user_id):
+    graphs = hrv_store.load_graphs(user_id)
+    rr = rr_intervals(graphs) if graphs else None
+    if rr is None or len(rr) < 2:
+        return user_id, None, None
+    return user_id, graphs[0]['token'], compute(rr)
+
+# recomputes the metrics of every user with stored graphs across a pool of
+# worker processes, returns how many users got metrics. The workers are
+# spawned, a forked one would share this process' pooled sqlite connections.
+def recompute_all(workers=None):
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for user_id, token, metrics in pool.map(_recompute, hrv_store.users(), chunksize=16):
+            if metrics is not None:
+                save_metrics(user_id, token, metrics)
+                done += 1
+    return done
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    started = time.perf_counter()
+    count = recompute_all()
+    logger.info("Recomputed hrv metrics of %d users in %.1fs", count, time.perf_counter() - started)
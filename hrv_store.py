@@ -0,0 +1,94 @@
+import time
+
+import numpy
+
+import db_handler
+
+# The graph arrays of a user's ecg4everybody payload are kept in the
+# hrv_graphs table of the bot database, one row per (user, title). The data
+# is stored unscaled as packed little endian float32, so reading it back is
+# a numpy.frombuffer over the blob without any copy or per-value parsing.
+DTYPE = numpy.dtype('<f4')
+
+# the titles graphs are stored under: (user, title) is the table's key, so
+# a repeated or missing title gets " (2)", " (3)"... appended
+def titles(graphs):
+    seen = set()
+    result = []
+    for graph in graphs:
+        base = title = graph.get('title') or ""
+        number = 1
+        while title in seen:
+            number += 1
+            title = f"{base} ({number})"
+        seen.add(title)
+        result.append(title)
+    return result
+
+# packs one payload graph into an hrv_graphs row
+def _row(user_id, token, graph, title, now):
+    data = numpy.asarray(graph['data'], dtype=DTYPE)
+    scale = graph.get('scale')
+    # a missing or empty scale means the data is already in its unit
+    scale = float(scale) if scale not in (None, "") else None
+    return (user_id, title, token, graph.get('x_unit', ""), graph.get('y_unit', ""),
+        scale, len(data), data.tobytes(), now)
+
+# method for storing every graph of a payload, replacing the user's older ones
+def save_graphs(user_id, token, graphs):
+    now = int(time.time())
+    rows = [_row(user_id, token, graph, title, now) for graph, title in zip(graphs, titles(graphs))]
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('DELETE FROM hrv_graphs WHERE user_id=?', (user_id,))
+        cur.executemany('INSERT INTO hrv_graphs '
+            '(user_id, title, token, x_unit, y_unit, scale, length, data, stored_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+def _graph(row):
+    title, token, x_unit, y_unit, scale, data, file_id = row
+    return {
+        'title': title,
+        'token': token,
+        # telegram file_id of the rendered graph once it has been sent
+        'file_id': file_id,
+        'x_unit': x_unit,
+        'y_unit': y_unit,
+        'scale': scale,
+        # read-only float32 view over the blob
+        'data': numpy.frombuffer(data, dtype=DTYPE),
+    }
+
+# gets one stored graph of the user, None if there is none with that title
+def load_graph(user_id, title):
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('SELECT title, token, x_unit, y_unit, scale, data, file_id FROM hrv_graphs '
+            'WHERE user_id=? AND title=?', (user_id, title))
+        row = cur.fetchone()
+    return _graph(row) if row else None
+
+# gets every stored graph of the user
+def load_graphs(user_id):
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('SELECT title, token, x_unit, y_unit, scale, data, file_id FROM hrv_graphs '
+            'WHERE user_id=? ORDER BY title', (user_id,))
+        rows = cur.fetchall()
+    return [_graph(row) for row in rows]
+
+# remembers the telegram file_id the rendered graph was sent with
+def set_file_id(user_id, title, file_id):
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('UPDATE hrv_graphs SET file_id=? WHERE user_id=? AND title=?',
+            (file_id, user_id, title))
+
+# whether the user has any stored graphs
+def has_graphs(user_id):
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('SELECT 1 FROM hrv_graphs WHERE user_id=? LIMIT 1', (user_id,))
+        return cur.fetchone() is not None
+
+# telegram ids of every user with stored graphs
+def users():
+    with db_handler.cursor(db_handler.BOT_DATABASE) as cur:
+        cur.execute('SELECT DISTINCT user_id FROM hrv_graphs')
+        rows = [row[0] for row in cur.fetchall()]
+    return rows
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import random
+
+# using separate configuration and parser
+from configparser import ConfigParser
+
+# httpx already comes with python-telegram-bot
+import httpx
+
+# request timings, see [METRICS]
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+# responses worth asking again for, anything else 4xx/5xx fails right away
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# HttpClient wraps one shared httpx.AsyncClient, so every request reuses the
+# same keep-alive connection pool instead of opening a new TCP/TLS session.
+# Each request has a timeout, failed requests are retried with exponential
+# backoff, and a semaphore per host caps how many requests run against it
+# at once. Pass transport (e.g. httpx.MockTransport) to talk to a stub
+# instead of the network.
+class HttpClient:
+    """Pooled async HTTP client with timeouts, retries and per-host limits."""
+
+    def __init__(self, timeout=10.0, retries=2, backoff=0.5, per_host=4,
+                 max_connections=20, transport=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.per_host = per_host
+        self.max_connections = max_connections
+        self.transport = transport
+        self._client = None
+        self._hosts = {}
+
+    def _get_client(self):
+        # created on first use so it binds to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                transport=self.transport,
+            )
+        return self._client
+
+    async def request(self, method, url, **kwargs):
+        """Sends a request and returns the successful httpx.Response.
+
+        Raises httpx.HTTPError once the retries are used up.
+        """
+        host = httpx.URL(url).host
+        limit = self._hosts.setdefault(host, asyncio.Semaphore(self.per_host))
+        client = self._get_client()
+        for attempt in range(self.retries + 1):
+            try:
+                async with limit:
+                    with instrumentation.timed('http_request_seconds', host=host):
+                        resp = await client.request(method, url, **kwargs)
+                instrumentation.inc('http_responses_total', host=host, status=resp.status_code)
+                resp.raise_for_status()
+                return resp
+            except httpx.HTTPStatusError as err:
+                if err.response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    raise
+                reason = err.response.status_code
+            except httpx.TransportError as err:
+                if attempt == self.retries:
+                    raise
+                reason = repr(err)
+            instrumentation.inc('http_retries_total', host=host)
+            # 0.5s, 1s, 2s... with jitter so retries from many users spread out
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning("%s %s failed (%s), retrying in %.1fs", method, url, reason, delay)
+            await asyncio.sleep(delay)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# shared client, see [HTTP] in env-example.cfg
+client = HttpClient(
+    timeout=cfg.getfloat('HTTP', 'timeout', fallback=10.0),
+    retries=cfg.getint('HTTP', 'retries', fallback=2),
+    per_host=cfg.getint('HTTP', 'per_host_limit', fallback=4),
+)
+
+async def post(url, **kwargs):
+    return await client.post(url, **kwargs)
+
+async def aclose():
+    await client.aclose()
@@ -1,22 +1,236 @@
 import sqlite3
 
-# method initdb creates eestec-database and creates one table with two columns
+# The schema is versioned with sqlite's user_version pragma. Each migration
+# below upgrades the database by one version inside a single transaction, so
+# an interrupted upgrade leaves the previous version intact and initdb just
+# picks up where it left off on the next start.
+# https://www.sqlite.org/pragma.html#pragma_user_version
+
+# version 1: data_table with an epoch timestamp, the telegram user id and a
+# metric name, indexed for per-user time range reads
+def _data_table_v1(c):
+    old = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='data_table'").fetchone()
+    if old:
+        c.execute('ALTER TABLE data_table RENAME TO data_table_v0')
+
+    c.execute('CREATE TABLE data_table('
+        'id INTEGER PRIMARY KEY,'
+        'user_id INTEGER NOT NULL,'
+        "metric TEXT NOT NULL DEFAULT 'data',"
+        'ts INTEGER NOT NULL,'
+        'value REAL NOT NULL)')
+    c.execute('CREATE INDEX data_user_metric_ts ON data_table(user_id, metric, ts)')
+
+    if old:
+        # old rows have no owner (user_id 0) and local time date strings.
+        # The data column had integer affinity, so every numeric value was
+        # stored as a number and anything else was junk text we can drop.
+        c.execute("INSERT INTO data_table (user_id, metric, ts, value) "
+            "SELECT 0, 'data', CAST(strftime('%s', date, 'utc') AS INTEGER), data "
+            "FROM data_table_v0 "
+            "WHERE typeof(data) IN ('integer', 'real') AND date IS NOT NULL "
+            "ORDER BY rowid")
+        c.execute('DROP TABLE data_table_v0')
+
+# rollup resolutions in seconds: minute, hour and day
+ROLLUP_RESOLUTIONS = (60, 3600, 86400)
+
+# version 2: data_rollup keeps min/max/sum/count of every user's metric per
+# minute, hour and day bucket. A trigger updates it on every insert into
+# data_table (including executemany batches), so long histories can be
+# plotted from a few hundred pre-aggregated rows.
+def _data_rollup_v2(c):
+    c.execute('CREATE TABLE data_rollup('
+        'user_id INTEGER NOT NULL,'
+        'metric TEXT NOT NULL,'
+        'resolution INTEGER NOT NULL,'
+        'bucket INTEGER NOT NULL,'
+        'min_value REAL NOT NULL,'
+        'max_value REAL NOT NULL,'
+        'sum_value REAL NOT NULL,'
+        'count INTEGER NOT NULL,'
+        'PRIMARY KEY (user_id, metric, resolution, bucket)) WITHOUT ROWID')
+
+    resolutions = ' UNION ALL '.join(f'SELECT {r} AS resolution' for r in ROLLUP_RESOLUTIONS)
+    c.execute('CREATE TRIGGER data_rollup_insert AFTER INSERT ON data_table BEGIN '
+        'INSERT INTO data_rollup '
+        'SELECT NEW.user_id, NEW.metric, r.resolution, NEW.ts - NEW.ts % r.resolution, '
+        'NEW.value, NEW.value, NEW.value, 1 '
+        f'FROM ({resolutions}) r WHERE true '
+        'ON CONFLICT (user_id, metric, resolution, bucket) DO UPDATE SET '
+        'min_value=min(min_value, excluded.min_value), '
+        'max_value=max(max_value, excluded.max_value), '
+        'sum_value=sum_value + excluded.sum_value, '
+        'count=count + 1; '
+        'END')
+
+    # aggregate the rows stored before this version
+    c.execute('INSERT INTO data_rollup '
+        'SELECT user_id, metric, r.resolution, ts - ts % r.resolution AS bucket, '
+        'min(value), max(value), sum(value), count(*) '
+        f'FROM data_table CROSS JOIN ({resolutions}) r '
+        'GROUP BY user_id, metric, r.resolution, bucket')
+
+DATA_MIGRATIONS = [_data_table_v1, _data_rollup_v2]
+
+# runs every migration newer than the database's user_version
+def migrate(conn, migrations):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, step in enumerate(migrations[version:], version + 1):
+        c = conn.cursor()
+        # take the write lock before looking at the version again, another
+        # process (e.g. a webhook worker) may be migrating at the same time
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            if c.execute('PRAGMA user_version').fetchone()[0] < number:
+                step(c)
+                c.execute(f'PRAGMA user_version={number}')
+            c.execute('COMMIT')
+        except sqlite3.Error:
+            c.execute('ROLLBACK')
+            raise
+
+# method initdb creates eestec-database and brings data_table up to date
 # https://www.sqlitetutorial.net/sqlite-python/sqlite-python-select/
 def initdb(db='eestec.db'):
 
-    # creating table
     # using connect, sqlite will try to open the file
-    conn = sqlite3.connect(db)
+    # isolation_level=None so migrate can manage its own transactions
+    conn = sqlite3.connect(db, isolation_level=None)
     conn.execute("PRAGMA encoding='UTF-8'")
-    # cursor allows you to execute sql code
-    c = conn.cursor()
 
-    # executing command CREATE TABLE to create table with two columns
-    c.execute('CREATE TABLE IF NOT EXISTS data_table('
-        'date text,'
-        'data integer)')
+    migrate(conn, DATA_MIGRATIONS)
 
-    # commit saves changes to the database
-    conn.commit()
     # finally closing connection
-    conn.close()
\ No newline at end of file
+    conn.close()
+
+# version 1 of the conversationbot database: users and hrv rows belong to a
+# telegram user id instead of being matched by first name, and are indexed
+# so a user's newest row is found without scanning the table
+def _bot_tables_v1(c):
+    c.execute('CREATE TABLE IF NOT EXISTS users('
+        'id INTEGER NOT NULL PRIMARY KEY,'
+        'name TEXT, gender TEXT, photo TEXT,'
+        'location TEXT, bio TEXT)')
+
+    c.execute('CREATE TABLE IF NOT EXISTS hrv('
+        'id INTEGER NOT NULL PRIMARY KEY, name TEXT,'
+        'summary TEXT, graphs TEXT, details TEXT)')
+
+    # rows written before this version keep user_id NULL, they can't be
+    # told apart reliably by first name
+    for table in ('users', 'hrv'):
+        c.execute(f'ALTER TABLE {table} ADD COLUMN user_id INTEGER')
+        c.execute(f'CREATE INDEX {table}_user_id ON {table}(user_id, id)')
+
+# version 2: the raw graph arrays of the user's ecg4everybody payload, one
+# row per graph title, data packed as little endian float32
+def _hrv_graphs_v2(c):
+    c.execute('CREATE TABLE hrv_graphs('
+        'user_id INTEGER NOT NULL,'
+        'title TEXT NOT NULL,'
+        'token TEXT,'
+        'x_unit TEXT, y_unit TEXT,'
+        'scale REAL,'
+        'length INTEGER NOT NULL,'
+        'data BLOB NOT NULL,'
+        'stored_at INTEGER NOT NULL,'
+        'PRIMARY KEY (user_id, title))')
+
+# version 3: hrv metrics cached per user and payload token, see hrv_metrics
+def _hrv_metrics_v3(c):
+    c.execute('CREATE TABLE hrv_metrics('
+        'user_id INTEGER PRIMARY KEY,'
+        'token TEXT,'
+        'metrics TEXT NOT NULL,'
+        'computed_at INTEGER NOT NULL)')
+
+# version 4: telegram file_ids of photos already sent, so they can be sent
+# again by id instead of being uploaded
+def _file_ids_v4(c):
+    for column in ('summary', 'graphs', 'details'):
+        c.execute(f'ALTER TABLE hrv ADD COLUMN {column}_file_id TEXT')
+    c.execute('ALTER TABLE hrv_graphs ADD COLUMN file_id TEXT')
+
+# photo columns that reference files of the blob store
+BLOB_COLUMNS = {'users': ('photo',), 'hrv': ('summary', 'graphs', 'details')}
+
+# version 5: the blobs table of blob_store. Triggers keep every blob's
+# refcount equal to the number of users/hrv columns pointing at its path;
+# paths outside the store (older photos) just match no blob.
+def _blobs_v5(c):
+    c.execute('CREATE TABLE blobs('
+        'sha256 TEXT PRIMARY KEY,'
+        'path TEXT NOT NULL UNIQUE,'
+        'size INTEGER NOT NULL,'
+        'refcount INTEGER NOT NULL DEFAULT 0,'
+        'created_at INTEGER NOT NULL)')
+    c.execute('CREATE INDEX blobs_refcount ON blobs(refcount)')
+
+    for table, columns in BLOB_COLUMNS.items():
+        for column in columns:
+            c.execute(f'CREATE TRIGGER {table}_{column}_blob AFTER UPDATE OF {column} ON {table} '
+                f'WHEN OLD.{column} IS NOT NEW.{column} BEGIN '
+                f'UPDATE blobs SET refcount=refcount - 1 WHERE path=OLD.{column}; '
+                f'UPDATE blobs SET refcount=refcount + 1 WHERE path=NEW.{column}; '
+                'END')
+        released = ' '.join(f'UPDATE blobs SET refcount=refcount - 1 WHERE path=OLD.{column};'
+            for column in columns)
+        c.execute(f'CREATE TRIGGER {table}_delete_blob AFTER DELETE ON {table} BEGIN {released} END')
+
+BOT_MIGRATIONS = [_bot_tables_v1, _hrv_graphs_v2, _hrv_metrics_v3, _file_ids_v4, _blobs_v5]
+
+# method initbotdb creates the users and hrv tables used by conversationbot
+# and brings them up to date
+def initbotdb(db='database.db'):
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.execute("PRAGMA encoding='UTF-8'")
+
+    migrate(conn, BOT_MIGRATIONS)
+
+    conn.close()
+
+# version 1 of the ecg4everybody payload cache: compressed bodies stored
+# once per content hash, and the i= tokens pointing at them
+def _cache_tables_v1(c):
+    c.execute('CREATE TABLE hrv_payloads('
+        'sha256 TEXT PRIMARY KEY,'
+        'size INTEGER NOT NULL,'
+        'body BLOB NOT NULL)')
+
+    c.execute('CREATE TABLE hrv_tokens('
+        'token TEXT PRIMARY KEY,'
+        'sha256 TEXT NOT NULL,'
+        'fetched_at INTEGER NOT NULL,'
+        'last_used INTEGER NOT NULL)')
+    c.execute('CREATE INDEX hrv_tokens_last_used ON hrv_tokens(last_used)')
+
+CACHE_MIGRATIONS = [_cache_tables_v1]
+
+# method initcachedb creates the cache database used by hrv_cache
+def initcachedb(db='cache.db'):
+    conn = sqlite3.connect(db, isolation_level=None)
+    migrate(conn, CACHE_MIGRATIONS)
+    conn.close()
+
+# version 1 of a bot's conversation state (see persistence.py): pickled
+# user/chat data per id, bot and callback data by name and conversation
+# states per handler name and key. WITHOUT ROWID keeps the small rows
+# clustered on their key, which keeps a 100k user table compact.
+def _state_tables_v1(c):
+    c.execute('CREATE TABLE user_data(user_id INTEGER PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID')
+    c.execute('CREATE TABLE chat_data(chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID')
+    c.execute('CREATE TABLE shared_data(name TEXT PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID')
+    c.execute('CREATE TABLE conversations('
+        'name TEXT NOT NULL,'
+        'key TEXT NOT NULL,'
+        'state BLOB NOT NULL,'
+        'PRIMARY KEY (name, key)) WITHOUT ROWID')
+
+STATE_MIGRATIONS = [_state_tables_v1]
+
+# method initstatedb creates the conversation state database of a bot
+def initstatedb(db):
+    conn = sqlite3.connect(db, isolation_level=None)
+    migrate(conn, STATE_MIGRATIONS)
+    conn.close()
@@ -26,6 +26,10 @@ from telegram.ext import (
 # using separate configuration and parser
 from configparser import ConfigParser
 
+import persistence
+import webhook
+import instrumentation
+
 # configparser
 cfg = ConfigParser()
 cfg.read('env.cfg')
@@ -99,12 +103,14 @@ async def store_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
     return ConversationHandler.END
 
-def main() -> None:
-    """Run the bot."""
+def build_application() -> Application:
+    """Creates the bot's Application with all handlers added."""
     # Create the Application and pass it your bot's token.
     application = (
         Application.builder()
         .token(TOKEN)
+        # conversations and user_data survive restarts
+        .persistence(persistence.SqlitePersistence('input_test_state.db'))
         .build()
     )
 
@@ -115,14 +121,25 @@ def main() -> None:
             STOREDATA: [MessageHandler(filters.TEXT & ~filters.COMMAND, store_data)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="storedata_handler",
+        persistent=True,
     )
 
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("start", start))
     application.add_handler(storedata_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    # handler latencies and errors, served on /metrics when [METRICS] is enabled
+    instrumentation.install(application)
+
+    return application
+
+
+def main() -> None:
+    """Run the bot."""
+    # Run the bot until the user presses Ctrl-C, by long polling or as
+    # webhook workers when [WEBHOOK] is enabled
+    webhook.run(build_application)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,216 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+
+from contextlib import nullcontext
+# using separate configuration and parser
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+# off by default: then observe/inc return right away, timed() hands out a
+# shared no-op context and handlers are not wrapped at all
+ENABLED = cfg.getboolean('METRICS', 'enabled', fallback=False)
+LISTEN = cfg.get('METRICS', 'listen', fallback='127.0.0.1')
+PORT = cfg.getint('METRICS', 'port', fallback=9108)
+
+# histogram bucket bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NULL = nullcontext()
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum and count."""
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# everything recorded, keyed by metric name and then by sorted label items
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+# name -> (callable returning the current value, labels)
+_gauges = {}
+
+
+def observe(name, seconds, **labels):
+    """Records a duration in the histogram name."""
+    if not ENABLED:
+        return
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(seconds)
+
+def inc(name, amount=1, **labels):
+    """Adds amount to the counter name."""
+    if not ENABLED:
+        return
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+def gauge(name, func, **labels):
+    """Registers func as the source of gauge name, it is called on every scrape."""
+    _gauges[(name, tuple(sorted(labels.items())))] = func
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+def timed(name, **labels):
+    """Context manager recording how long its block takes in histogram name."""
+    if not ENABLED:
+        return _NULL
+    return _Timer(name, labels)
+
+
+########## HANDLERS ##########
+
+# handler callbacks are wrapped once, so re-running install is harmless
+_WRAPPED = '_instrumented'
+
+def _wrap(callback):
+    if getattr(callback, _WRAPPED, False):
+        return callback
+    name = getattr(callback, '__name__', type(callback).__name__)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as err:
+            # ApplicationHandlerStop is how the rate limiter stops an update
+            if type(err).__name__ != 'ApplicationHandlerStop':
+                inc('handler_errors_total', handler=name, error=type(err).__name__)
+            raise
+        finally:
+            observe('handler_seconds', time.perf_counter() - started, handler=name)
+
+    setattr(wrapper, _WRAPPED, True)
+    return wrapper
+
+def _handlers(handler):
+    # a ConversationHandler holds more handlers, yield the leaves
+    inner = getattr(handler, 'entry_points', None)
+    if inner is None:
+        yield handler
+        return
+    for child in [*handler.entry_points, *handler.fallbacks,
+            *(h for state in handler.states.values() for h in state)]:
+        yield from _handlers(child)
+
+# wraps the callback of every handler added to application so far (call it
+# after adding them) and starts the metrics endpoint
+def install(application):
+    if not ENABLED:
+        return
+    for group in application.handlers.values():
+        for handler in group:
+            for leaf in _handlers(handler):
+                leaf.callback = _wrap(leaf.callback)
+    serve()
+
+
+########## ENDPOINT ##########
+
+def _labels(key, extra=()):
+    items = [*key, *extra]
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+def render():
+    """Everything recorded so far in the Prometheus text format."""
+    lines = []
+    with _lock:
+        for name, series in sorted(_counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f'{name}{_labels(key)} {value}' for key, value in series.items())
+        for name, series in sorted(_histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip((*histogram.bounds, '+Inf'), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(key, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{_labels(key)} {histogram.sum}')
+                lines.append(f'{name}_count{_labels(key)} {histogram.count}')
+    for (name, key), func in sorted(_gauges.items(), key=lambda item: item[0]):
+        try:
+            value = func()
+        except Exception:
+            continue
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name}{_labels(key)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the bot's log
+        pass
+
+_server = None
+
+# serves /metrics from a daemon thread. Webhook workers share the config, so
+# when the port is taken the next free one is used and logged.
+def serve(attempts=16):
+    global _server
+    if _server is not None:
+        return _server
+    for port in range(PORT, PORT + attempts):
+        try:
+            _server = ThreadingHTTPServer((LISTEN, port), _MetricsHandler)
+        except OSError:
+            continue
+        threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", LISTEN, port)
+        return _server
+    logger.warning("No free port for metrics in %d-%d", PORT, PORT + attempts - 1)
+    return None
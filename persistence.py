@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+import pickle
+
+# using separate configuration and parser
+from configparser import ConfigParser
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import initdatabase
+import db_handler
+import db_async
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+# seconds between the application's persistence updates
+UPDATE_INTERVAL = cfg.getfloat('PERSISTENCE', 'update_interval', fallback=10.0)
+
+# marks a row to be deleted in a pending write
+_DROP = object()
+
+
+# SqlitePersistence keeps a bot's user_data, chat_data, bot_data and
+# ConversationHandler states in a sqlite database, so a restarted bot picks
+# every conversation up where it was. The application hands over what
+# changed every update_interval seconds; all of it is written in a single
+# transaction on the db_async writer thread, skipping values whose pickle
+# didn't change since the last write. Conversation states are only read
+# when their handler asks for them, one handler name at a time.
+class SqlitePersistence(BasePersistence):
+    """PTB persistence backed by a sqlite database (see initdatabase.initstatedb)."""
+
+    def __init__(self, db, store_data=None, update_interval=UPDATE_INTERVAL):
+        super().__init__(store_data=store_data or PersistenceInput(), update_interval=update_interval)
+        self.db = db
+        initdatabase.initstatedb(db)
+        # (table, key) -> pickled value or _DROP, waiting for the next write
+        self._pending = {}
+        # (table, key) -> pickled value as last written, to skip unchanged ones
+        self._written = {}
+        self._writing = None
+
+    # blocking part of the loaders, run on a reader thread
+    def _load(self, sql, args=()):
+        with db_handler.cursor(self.db) as cur:
+            cur.execute(sql, args)
+            return cur.fetchall()
+
+    async def _load_table(self, table, column):
+        rows = await db_async.read(self._load, f'SELECT {column}, data FROM {table}')
+        for key, data in rows:
+            self._written[(table, key)] = data
+        return {key: pickle.loads(data) for key, data in rows}
+
+    async def _load_shared(self, name):
+        rows = await db_async.read(self._load, 'SELECT data FROM shared_data WHERE name=?', (name,))
+        if not rows:
+            return None
+        self._written[('shared_data', name)] = rows[0][0]
+        return pickle.loads(rows[0][0])
+
+    async def get_user_data(self):
+        return await self._load_table('user_data', 'user_id')
+
+    async def get_chat_data(self):
+        return await self._load_table('chat_data', 'chat_id')
+
+    async def get_bot_data(self):
+        data = await self._load_shared('bot_data')
+        return {} if data is None else data
+
+    async def get_callback_data(self):
+        return await self._load_shared('callback_data')
+
+    async def get_conversations(self, name):
+        rows = await db_async.read(self._load,
+            'SELECT key, state FROM conversations WHERE name=?', (name,))
+        for key, state in rows:
+            self._written[('conversations', (name, key))] = state
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def _queue(self, table, key, value):
+        if value is _DROP:
+            if (table, key) not in self._written:
+                # never written, nothing to delete
+                self._pending.pop((table, key), None)
+                return
+            self._pending[(table, key)] = _DROP
+        else:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if self._written.get((table, key)) == data:
+                self._pending.pop((table, key), None)
+                return
+            self._pending[(table, key)] = data
+        # the application calls all update_* methods of a run together, the
+        # write is started after them so the whole run is one transaction
+        if self._writing is None:
+            self._writing = asyncio.create_task(self._write_soon())
+
+    async def _write_soon(self):
+        try:
+            await asyncio.sleep(0)
+            # changes queued while a write is running go in the next one
+            while self._pending:
+                await self._write()
+        finally:
+            self._writing = None
+
+    async def _write(self):
+        pending, self._pending = self._pending, {}
+        if pending:
+            await db_async.write(self._commit, pending)
+            for key, data in pending.items():
+                if data is _DROP:
+                    self._written.pop(key, None)
+                else:
+                    self._written[key] = data
+
+    # blocking part of a write, run on the writer thread
+    def _commit(self, pending):
+        with db_handler.cursor(self.db) as cur:
+            for (table, key), data in pending.items():
+                if table == 'conversations':
+                    name, conv_key = key
+                    if data is _DROP:
+                        cur.execute('DELETE FROM conversations WHERE name=? AND key=?', (name, conv_key))
+                    else:
+                        cur.execute('INSERT OR REPLACE INTO conversations (name, key, state) '
+                            'VALUES (?, ?, ?)', (name, conv_key, data))
+                else:
+                    column = {'user_data': 'user_id', 'chat_data': 'chat_id', 'shared_data': 'name'}[table]
+                    if data is _DROP:
+                        cur.execute(f'DELETE FROM {table} WHERE {column}=?', (key,))
+                    else:
+                        cur.execute(f'INSERT OR REPLACE INTO {table} ({column}, data) VALUES (?, ?)',
+                            (key, data))
+        logger.debug("Persisted %d changes to %s", len(pending), self.db)
+
+    async def update_user_data(self, user_id, data):
+        # empty dicts aren't stored, most users never have any data
+        self._queue('user_data', user_id, data if data else _DROP)
+
+    async def update_chat_data(self, chat_id, data):
+        self._queue('chat_data', chat_id, data if data else _DROP)
+
+    async def update_bot_data(self, data):
+        self._queue('shared_data', 'bot_data', data)
+
+    async def update_callback_data(self, data):
+        self._queue('shared_data', 'callback_data', data)
+
+    async def update_conversation(self, name, key, new_state):
+        value = _DROP if new_state is None else new_state
+        self._queue('conversations', (name, json.dumps(list(key))), value)
+
+    async def drop_user_data(self, user_id):
+        self._queue('user_data', user_id, _DROP)
+
+    async def drop_chat_data(self, chat_id):
+        self._queue('chat_data', chat_id, _DROP)
+
+    # this bot is the only writer of its state, nothing to refresh
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Writes whatever is still pending, called when the application stops."""
+        if self._writing is not None:
+            await self._writing
+        await self._write()
@@ -1,4 +1,7 @@
+import asyncio
 import logging
+import tempfile
+import time
 
 from telegram import __version__ as TG_VER
 
@@ -14,6 +17,7 @@ if __version_info__ < (20, 0, 0, "alpha", 1):
         f"visit https://docs.python-telegram-bot.org/en/v{TG_VER}/examples.html"
     )
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     ConversationHandler,
@@ -28,9 +32,18 @@ from configparser import ConfigParser
 # import initdb and handler to it
 import initdatabase
 import db_handler
-# get access to data plotter
-import matplotlib.pyplot as plt
-import numpy
+# non-blocking wrappers around db_handler for the async handlers
+import db_async
+import hrv_store
+import persistence
+import webhook
+import instrumentation
+import throttle
+# get access to data plotter and the worker processes that run it
+import data_plotter
+import render_service
+# rendered charts of unchanged data
+import chart_cache
 
 # configparser
 cfg = ConfigParser()
@@ -46,10 +59,16 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # declaring constants
-STOREDATA, PLOTDATA = range(2)
+STOREDATA, PLOTDATA, SELECT_EXPORTER, IMPORTDATA = range(4)
+# width of /plot charts in pixels, see data_plotter.render
+PLOT_WIDTH = 640
+# seconds between /import progress messages
+IMPORT_PROGRESS_INTERVAL = 2
 
 # calling method initdb creates 
 initdatabase.initdb()
+# /export reads the hrv graphs conversationbot stores
+initdatabase.initbotdb()
 
 # when /start is issued
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -59,6 +78,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "/help lists these commands.\n"
         "/new let's you input new data value.\n"
         "/plot function initiates plotting of chosen data.\n"
+        "/export sends your stored data as a file.\n"
+        "/import loads your earlier data from a csv or json file.\n"
         "/cancel cancels current action.\n"
         # TODO: add the commands you need.  
     )
@@ -69,6 +90,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text(
         "/new let's you input new data value.\n"
         "/plot function initiates plotting of chosen data.\n"
+        "/export sends your stored data as a file.\n"
+        "/import loads your earlier data from a csv or json file.\n"
         "/cancel cancels current action.\n"
         # TODO: add commands you need here too
     )
@@ -100,8 +123,14 @@ async def store_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     new_data = update.message.text
 
     # we are calling add_data method from database handler
-    # # it takes the new_data as parameter 
-    db_handler.add_data(new_data)
+    # it takes the new_data and the user's id as parameters
+    try:
+        await db_async.add_data(new_data, user.id)
+    except ValueError:
+        await update.message.reply_text(
+            "That is not a number, please send a numeric value: "
+        )
+        return STOREDATA
 
     # Logging new_data and username
     logger.info(
@@ -118,10 +147,12 @@ async def store_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 # called when /plot command is given
 async def plotter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Asks user what data they want to plot."""
+    user = update.message.from_user
+    # list the metrics this user has stored, /new stores 'data'
+    metrics = await db_async.get_metrics(user.id) or ["data"]
     await update.message.reply_text(
         "What data do you want to plot?\n"
-        "Options: data"
-        #TODO: expand if you want to plot from several different datasources
+        "Options: " + ", ".join(metrics)
     )
     return PLOTDATA
 
@@ -138,46 +169,175 @@ async def plot_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Plotting.. : "
     )
 
-    # getdatapoint method is called from db_handler
-    data = db_handler.getdatapoint()
-    # received data is given as a parameter to plot method from data plotter
-    plot(data)
-    
+    # an unchanged chart is served from the cache, keyed on how far the
+    # series has been written, and re-sent by its telegram file_id
+    key = chart_cache.cache.key(user.id, chosen_data, None, None, PLOT_WIDTH,
+        await db_async.high_water(user.id, chosen_data))
+    try:
+        # the same chart asked for again while it is still being drawn
+        # shares the drawing, every update gets its own reply
+        chart = await throttle.coalesce(("plot", key), draw_chart, key, user.id, chosen_data)
+    except render_service.RenderBusy:
+        await update.message.reply_text(
+            "I'm drawing a lot of charts right now, please try /plot again in a moment."
+        )
+        return ConversationHandler.END
+    if chart is None:
+        await update.message.reply_text(f"You have no stored {chosen_data} values yet.")
+        return ConversationHandler.END
+
+    png, file_id = chart
+    if file_id is not None:
+        try:
+            await update.message.reply_photo(photo=file_id)
+            await update.message.reply_text(update.message.text)
+            return ConversationHandler.END
+        except BadRequest:
+            # telegram doesn't know the id (anymore), upload instead
+            logger.warning("Cached file_id of %s chart rejected", chosen_data)
+
     # replies to user with plotted graph
-    await update.message.reply_photo(photo=open('data_plot.png','rb'))
+    message = await update.message.reply_photo(photo=png)
+    await chart_cache.cache.set_file_id(key, message.photo[-1].file_id)
     await update.message.reply_text(update.message.text)
     return ConversationHandler.END
 
-def plot(data):
-    hrv_datetime = {}
-    hrv_timestamps = []
-    hrv_datapoints = []
-    for row in data:
-        print(row)
-        date = row[0].split(" ")[0]
-        time = row[0].split(" ")[1]
-        hrv_datetime['year'] = int(date.split("-")[0])
-        hrv_datetime['month'] = int(date.split("-")[1])
-        hrv_datetime['day'] = int(date.split("-")[2])
-        hrv_datetime['hour'] = int(time.split(":")[0])
-        hrv_datetime['minute'] = int(time.split(":")[1])
-        print(hrv_datetime['month'])
-        print(hrv_datetime['day'])
-        print(hrv_datetime['hour'])
-        hrv_timestamps.append(hrv_datetime['day'])
-        hrv_datapoints.append(int(row[1]))
-
-    plt.plot(hrv_datapoints)
-    plt.xlabel('Time')
-    plt.ylabel('Value (unit)')
-    plt.savefig('data_plot.png')
+# (png, file_id) of the chart of key, None if there is no data to plot
+async def draw_chart(key, user_id, chosen_data: str):
+    cached = await chart_cache.cache.get(key)
+    if cached is not None:
+        return cached
+    # get_series method is called from db_handler, it only reads the chosen
+    # metric of this user, pre-aggregated to about one row per pixel
+    data = await db_async.get_series(user_id, chosen_data, width=PLOT_WIDTH)
+    if not data:
+        return None
+    # received data is turned into a plot spec by data_plotter and drawn by a
+    # render worker process, so other users aren't blocked meanwhile
+    png = await render_service.render(data_plotter.data_spec(data, chosen_data))
+    await chart_cache.cache.put(key, png)
+    return png, None
 
-def main() -> None:
-    """Run the bot."""
+# answers updates that arrive while a chart is still being drawn, plot_data
+# runs with block=False
+async def still_plotting(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_message is not None:
+        await update.effective_message.reply_text("I'm still drawing your last chart, one moment please.")
+
+# the series a user can export
+async def export_options(user_id) -> list:
+    options = (await db_async.get_metrics(user_id) or ["data"]) + [db_handler.EXPORT_ALL]
+    if await db_async.read(hrv_store.has_graphs, user_id):
+        options.append(db_handler.EXPORT_HRV)
+    return options
+
+# called when /export command is given
+async def exporter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Asks user what data they want to export."""
+    user = update.message.from_user
+    options = await export_options(user.id)
+    await update.message.reply_text(
+        "What data do you want to export?\n"
+        "Options: " + ", ".join(options) + "\n"
+        "Add 'columnar' after it for the binary format instead of csv."
+    )
+    return SELECT_EXPORTER
+
+# called when SELECT_EXPORTER state is reached in exporter_handler conversation
+async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Sends the chosen data as a compressed document."""
+    user = update.message.from_user
+    chosen_data = update.message.text.strip()
+    fmt = 'csv'
+    for name in db_handler.EXPORT_FORMATS:
+        if chosen_data.endswith(' ' + name):
+            chosen_data, fmt = chosen_data[:-len(name)].strip(), name
+    options = await export_options(user.id)
+    if chosen_data not in options:
+        await update.message.reply_text(
+            f"You have no {chosen_data} data.\n"
+            "Options: " + ", ".join(options)
+        )
+        return SELECT_EXPORTER
+    logger.info("Exporting %s as %s for user %s", chosen_data, fmt, user.first_name)
+
+    await update.message.reply_text("Exporting.. ")
+    # read in chunks on a reader thread and compressed on the way, large
+    # exports spill to a temporary file instead of memory
+    document, filename = await db_async.export(user.id, chosen_data, fmt)
+    with document:
+        await update.message.reply_document(document=document, filename=filename)
+    return ConversationHandler.END
+
+# called when /import command is given
+async def importer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Asks user for the file to import."""
+    await update.message.reply_text(
+        "Send me a csv or json file with value and ts (or time) columns, "
+        "and metric if it holds more than your /new data. "
+        "Files made by /export work too."
+    )
+    return IMPORTDATA
+
+# called when IMPORTDATA state is reached in importer_handler conversation
+async def import_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Loads the uploaded file into the database."""
+    user = update.message.from_user
+    document = update.message.document
+    logger.info("Importing %s for user %s", document.file_name, user.first_name)
+
+    status = await update.message.reply_text("Importing.. ")
+    shown = time.monotonic()
+    # the last progress edit, finished before the result replaces it
+    editing = None
+
+    # progress of every written chunk, shown at most every couple of seconds
+    def progress(rows, seconds):
+        nonlocal shown, editing
+        if time.monotonic() - shown >= IMPORT_PROGRESS_INTERVAL and (editing is None or editing.done()):
+            shown = time.monotonic()
+            editing = context.application.create_task(
+                status.edit_text(f"Importing.. {rows} rows ({rows / seconds:.0f} rows/s)"))
+
+    async def shown_progress():
+        if editing is not None:
+            await asyncio.gather(editing, return_exceptions=True)
+
+    with tempfile.SpooledTemporaryFile(max_size=db_handler.EXPORT_SPOOL) as upload:
+        await (await document.get_file()).download(out=upload)
+        upload.seek(0)
+        try:
+            result = await db_async.import_data(user.id, upload, progress)
+        except ValueError as err:
+            await shown_progress()
+            await status.edit_text(f"I couldn't read that file: {err}")
+            return ConversationHandler.END
+
+    lines = [f"Imported {result['rows']} rows in {result['seconds']:.1f}s "
+        f"({result['rows'] / max(result['seconds'], 1e-6):.0f} rows/s)."]
+    if result['rejected']:
+        lines.append(f"Skipped {result['rejected']} invalid rows:")
+    lines.extend(result['errors'])
+    await shown_progress()
+    await status.edit_text("\n".join(lines))
+    return ConversationHandler.END
+
+async def close(application: Application) -> None:
+    # flush buffered datapoints, finish queued writes and return the pooled connections
+    db_async.shutdown()
+    # stop the chart render workers
+    render_service.shutdown()
+
+
+def build_application() -> Application:
+    """Creates the bot's Application with all handlers added."""
     # Create the Application and pass it your bot's token.
     application = (
         Application.builder()
         .token(TOKEN)
+        .post_shutdown(close)
+        # conversations and user_data survive restarts
+        .persistence(persistence.SqlitePersistence('plotter_state.db'))
         .build()
     )
 
@@ -188,23 +348,61 @@ def main() -> None:
             STOREDATA: [MessageHandler(filters.TEXT & ~filters.COMMAND, store_data)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="storedata_handler",
+        persistent=True,
     )
 
     plotter_handler = ConversationHandler(
         entry_points=[CommandHandler("plot", plotter)],
         states={
-            PLOTDATA: [MessageHandler(filters.TEXT & ~filters.COMMAND, plot_data)],
+            PLOTDATA: [MessageHandler(filters.TEXT & ~filters.COMMAND, plot_data, block=False)],
+            ConversationHandler.WAITING: [MessageHandler(filters.ALL, still_plotting)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="plotter_handler",
+        persistent=True,
     )
 
+    exporter_handler = ConversationHandler(
+        entry_points=[CommandHandler("export", exporter)],
+        states={
+            SELECT_EXPORTER: [MessageHandler(filters.TEXT & ~filters.COMMAND, export_data)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="exporter_handler",
+        persistent=True,
+    )
+
+    importer_handler = ConversationHandler(
+        entry_points=[CommandHandler("import", importer)],
+        states={
+            IMPORTDATA: [MessageHandler(filters.Document.ALL, import_data)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="importer_handler",
+        persistent=True,
+    )
+
+    # per user and per command limits run before any of the handlers below
+    throttle.install(application)
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("start", start))
     application.add_handler(storedata_handler)
     application.add_handler(plotter_handler)
+    application.add_handler(exporter_handler)
+    application.add_handler(importer_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    # handler latencies and errors, served on /metrics when [METRICS] is enabled
+    instrumentation.install(application)
+
+    return application
+
+
+def main() -> None:
+    """Run the bot."""
+    # Run the bot until the user presses Ctrl-C, by long polling or as
+    # webhook workers when [WEBHOOK] is enabled
+    webhook.run(build_application)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+# using separate configuration and parser
+from configparser import ConfigParser
+
+# the rendering itself, imported again by every worker process
+import data_plotter
+# render timings and queue depth, see [METRICS]
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+
+class RenderBusy(Exception):
+    """Raised when too many charts are already waiting for a worker."""
+
+
+# RenderService renders plot specs (see data_plotter) in a pool of worker
+# processes, so matplotlib never blocks the bot's event loop. At most
+# `workers` charts render at once; up to `max_queue` more may wait for a
+# free worker, after that render() fails fast with RenderBusy.
+class RenderService:
+    """Process pool that turns plot specs into PNG bytes."""
+
+    def __init__(self, workers=2, max_queue=32):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool = None
+        self._slots = asyncio.Semaphore(workers)
+        # charts waiting for a worker, and charts being rendered right now
+        self.queued = 0
+        self.running = 0
+
+    @property
+    def queue_depth(self):
+        return self.queued
+
+    def _executor(self):
+        # started on first use, so importing this module is cheap. spawn: the
+        # bot already runs database, batch and http threads that a forked
+        # worker would inherit in whatever state they were in
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def _submit(self, func, arg):
+        if self.queued >= self.max_queue:
+            instrumentation.inc('render_busy_total')
+            raise RenderBusy(f"{self.queued} charts already waiting")
+        self.queued += 1
+        try:
+            with instrumentation.timed('render_wait_seconds'):
+                await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with instrumentation.timed('render_seconds', func=func.__name__):
+                return await loop.run_in_executor(self._executor(), func, arg)
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    async def render(self, spec, save_to=None):
+        """Renders a plot spec in a worker process and returns the PNG bytes.
+
+        The bytes can be passed straight to reply_photo. If save_to is given
+        the PNG is also written there (atomically, off the event loop).
+        """
+        png = await self._submit(data_plotter.render, spec)
+        if save_to is not None:
+            await asyncio.to_thread(save_png, png, save_to)
+        return png
+
+    async def render_many(self, specs, save_to=None):
+        """Renders several specs in a single worker call, e.g. every graph
+        of a payload, and returns their PNG bytes in order.
+
+        save_to is an optional list of paths, one per spec.
+        """
+        pngs = await self._submit(data_plotter.render_many, specs)
+        if save_to is not None:
+            await asyncio.to_thread(lambda: [save_png(png, path) for png, path in zip(pngs, save_to)])
+        return pngs
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+# writes png to path through a temporary file in the same directory, so
+# concurrent renders of the same chart never leave a half written file
+def save_png(png, path):
+    folder = os.path.dirname(path) or '.'
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# shared service, see [RENDER] in env-example.cfg
+service = RenderService(
+    workers=cfg.getint('RENDER', 'workers', fallback=2),
+    max_queue=cfg.getint('RENDER', 'max_queue', fallback=32),
+)
+instrumentation.gauge('render_queue_depth', lambda: service.queue_depth)
+instrumentation.gauge('render_running', lambda: service.running)
+
+async def render(spec, save_to=None):
+    return await service.render(spec, save_to)
+
+async def render_many(specs, save_to=None):
+    return await service.render_many(specs, save_to)
+
+def shutdown():
+    service.shutdown()
@@ -1,7 +1,15 @@
 #%%
-import requests, json
+import asyncio
+# fetches go through the same cache as the bot, so re-running this is free
+import hrv_cache
+import http_client
 
-resp = requests.post('https://ecg4everybody.com/service/getdata.php', data = {'i': "cGJTZDVSMlc1djVTRWRqT0c2SWRmdz09"})
-resp = json.loads(resp.text)
-print(resp)
+async def fetch(token):
+    try:
+        return await hrv_cache.fetch(token)
+    finally:
+        await http_client.aclose()
 
+resp = asyncio.run(fetch("cGJTZDVSMlc1djVTRWRqT0c2SWRmdz09"))
+print(resp)
+print(hrv_cache.stats())
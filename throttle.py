@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+
+# using separate configuration and parser
+from configparser import ConfigParser
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+ENABLED = cfg.getboolean('RATE_LIMIT', 'enabled', fallback=True)
+# updates the application handles at the same time, 1 handles them one by
+# one. The slow handlers (/plot, /restore, fetching a /link) are registered
+# with block=False, so they run as tasks and never hold up the others.
+CONCURRENT_UPDATES = cfg.getint('RATE_LIMIT', 'concurrent_updates', fallback=1)
+
+# limits as "count/seconds": count updates per seconds, all of them may come at once
+DEFAULT_LIMITS = {'user': '20/60', 'plot': '3/30', 'link': '3/60', 'restore': '3/30'}
+
+# buckets kept before idle (full) ones are dropped
+MAX_BUCKETS = 10000
+
+
+def parse_limit(text):
+    """Returns (rate per second, burst) of a "count/seconds" limit."""
+    count, seconds = text.split('/')
+    return int(count) / float(seconds), int(count)
+
+
+# TokenBucket allows burst requests at once and refills at rate per second
+class TokenBucket:
+    """Token bucket of one user, or of one user's command."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # the user was told to slow down and hasn't recovered yet
+        self.warned = False
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Takes a token, returns 0 or the seconds until one is available."""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.warned = False
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+
+# RateLimiter runs before every other handler (group -1) and stops updates
+# of users that are over their limits: one bucket per user for everything
+# they send, and one per user and command for the limited commands. The
+# first rejected update gets a reply saying how long to wait, the rest are
+# dropped quietly.
+class RateLimiter:
+    """Per user and per command token bucket limits for an Application."""
+
+    def __init__(self, limits):
+        self.limits = {name: parse_limit(limit) for name, limit in limits.items()}
+        self._buckets = {}
+        self.rejected = 0
+
+    def _bucket(self, key, name):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(*self.limits[name])
+        return bucket
+
+    def _prune(self):
+        for key in [key for key, bucket in self._buckets.items() if bucket.full()]:
+            del self._buckets[key]
+
+    @staticmethod
+    def command(update):
+        text = update.message.text if update.message else None
+        if not text or not text.startswith('/'):
+            return None
+        # "/plot@some_bot args" -> "plot"
+        words = text[1:].split(maxsplit=1)
+        return words[0].split('@')[0].lower() if words else None
+
+    async def __call__(self, update, context):
+        user = update.effective_user
+        if user is None:
+            return
+        checks = [((user.id, None), 'user')] if 'user' in self.limits else []
+        command = self.command(update)
+        if command in self.limits and command != 'user':
+            checks.append(((user.id, command), command))
+
+        for key, name in checks:
+            bucket = self._bucket(key, name)
+            wait = bucket.take()
+            if wait:
+                self.rejected += 1
+                if not bucket.warned and update.effective_message is not None:
+                    bucket.warned = True
+                    logger.info("Rate limited %s on %s for %.0fs", user.first_name, name, wait)
+                    await update.effective_message.reply_text(
+                        f"You're going a bit fast, please wait {wait:.0f}s and try again.")
+                raise ApplicationHandlerStop
+
+    def install(self, application):
+        """Registers the limiter in front of every handler of application."""
+        application.add_handler(TypeHandler(Update, self), group=-1)
+
+
+# in-flight calls by key, see coalesce
+_in_flight = {}
+
+async def coalesce(key, func, *args):
+    """Awaits func(*args), sharing one call between concurrent callers of key.
+
+    A caller that arrives while a call with the same key is still running
+    gets that call's result (or exception) instead of starting another one.
+    """
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(func(*args))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    else:
+        logger.debug("Joining in-flight %s", key)
+    # shielded, so one caller giving up doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+
+# puts the limits of [RATE_LIMIT] in env.cfg in front of application's handlers
+def install(application):
+    if not ENABLED:
+        return None
+    limits = dict(DEFAULT_LIMITS)
+    if cfg.has_section('RATE_LIMIT'):
+        limits.update((name, value) for name, value in cfg.items('RATE_LIMIT') if '/' in value)
+    limiter = RateLimiter(limits)
+    limiter.install(application)
+    return limiter
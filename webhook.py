@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+
+# using separate configuration and parser
+from configparser import ConfigParser
+
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+# configparser
+cfg = ConfigParser()
+cfg.read('env.cfg')
+
+ENABLED = cfg.getboolean('WEBHOOK', 'enabled', fallback=False)
+LISTEN = cfg.get('WEBHOOK', 'listen', fallback='127.0.0.1')
+PORT = cfg.getint('WEBHOOK', 'port', fallback=8443)
+URL_PATH = '/' + cfg.get('WEBHOOK', 'url_path', fallback='telegram').strip('/')
+# address telegram posts to, usually a reverse proxy in front of LISTEN:PORT
+PUBLIC_URL = cfg.get('WEBHOOK', 'public_url', fallback='')
+SECRET_TOKEN = cfg.get('WEBHOOK', 'secret_token', fallback='') or None
+WORKERS = cfg.getint('WEBHOOK', 'workers', fallback=multiprocessing.cpu_count())
+# updates waiting for one worker before the ingress answers 503
+WORKER_QUEUE = cfg.getint('WEBHOOK', 'worker_queue', fallback=256)
+# updates a worker has handed to its application but not finished
+WORKER_BACKLOG = cfg.getint('WEBHOOK', 'worker_backlog', fallback=64)
+# seconds the workers get to finish their updates on shutdown
+DRAIN_TIMEOUT = cfg.getfloat('WEBHOOK', 'drain_timeout', fallback=30.0)
+
+MAX_BODY = 1024 * 1024
+
+
+# every bot module has a build_application() returning its Application with
+# all handlers added; run() starts it by long polling, or with [WEBHOOK]
+# enabled, as an ingress process and WORKERS application processes
+def run(build_application):
+    if not ENABLED:
+        build_application().run_polling()
+        return
+    Ingress(build_application).run()
+
+
+# the user an update is from, so all of a user's updates go to the same
+# worker and its conversation state stays in one process
+def route_key(data):
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('chat') or value.get('user')
+            if isinstance(sender, dict) and 'id' in sender:
+                return sender['id']
+            message = value.get('message')
+            if isinstance(message, dict) and 'chat' in message:
+                return message['chat']['id']
+    return data.get('update_id', 0)
+
+
+########## WORKER PROCESSES ##########
+
+# entry point of a worker process: builds the bot's application (its updater
+# stays unused) and feeds it the updates the ingress routes here. None on the
+# queue means drain: finish what was received, then shut down.
+def _worker(build_application, updates, number):
+    logging.basicConfig(
+        format=f"%(asctime)s - worker {number} - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    # the ingress handles signals and tells the worker when to stop; systemd
+    # (KillMode=control-group) and Ctrl-C send them to every process of the
+    # group, and a worker dying right away would skip the drain
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_serve_worker(build_application(), updates))
+
+# start()/stop() don't run the post_init and post_shutdown hooks the way
+# run_polling does, so they are called here; the bots flush their database
+# writes and photo downloads in post_shutdown
+async def _serve_worker(application, updates):
+    loop = asyncio.get_running_loop()
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        while True:
+            # backpressure: leave updates in the shared queue (which makes
+            # the ingress answer 503) while the application is behind
+            while application.update_queue.qsize() >= WORKER_BACKLOG:
+                await asyncio.sleep(0.05)
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        # stop() drops whatever is still queued, so wait for it first
+        while not application.update_queue.empty():
+            await asyncio.sleep(0.05)
+        await application.stop()
+    # after shutdown(), as run_polling does
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+########## INGRESS ##########
+
+# Ingress is the process telegram posts updates to. It checks the secret
+# token, routes every update by user id to one of the worker processes and
+# answers right away; when that worker's queue is full it answers 503 and
+# telegram delivers the update again later. On SIGINT/SIGTERM it stops
+# accepting, deletes the webhook it set (telegram keeps new updates for
+# the next start, webhook or polling) and lets the workers finish what they
+# already got.
+class Ingress:
+    """Webhook HTTP server fanning updates out to worker processes."""
+
+    def __init__(self, build_application, workers=WORKERS):
+        self.build_application = build_application
+        self.workers = workers
+        self._queues = []
+        self._processes = []
+        self._draining = False
+        self.accepted = 0
+        self.rejected = 0
+
+    def _start_workers(self):
+        # spawn: the workers start clean instead of inheriting this process' threads
+        context = multiprocessing.get_context('spawn')
+        for number in range(self.workers):
+            updates = context.Queue(maxsize=WORKER_QUEUE)
+            process = context.Process(target=_worker, name=f"bot-worker-{number}",
+                args=(self.build_application, updates, number))
+            process.start()
+            self._queues.append(updates)
+            self._processes.append(process)
+
+    def route(self, data):
+        """Queues an update for its worker, returns False if that worker is full."""
+        try:
+            self._queues[route_key(data) % self.workers].put_nowait(data)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def _respond(self, writer, status, reason):
+        retry = "Retry-After: 1\r\n" if status == 503 else ""
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\n{retry}\r\n".encode())
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, "Payload Too Large")
+                    break
+                body = await reader.readexactly(length)
+
+                if method != 'POST' or path != URL_PATH:
+                    await self._respond(writer, 404, "Not Found")
+                elif SECRET_TOKEN and headers.get('x-telegram-bot-api-secret-token') != SECRET_TOKEN:
+                    await self._respond(writer, 403, "Forbidden")
+                elif self._draining:
+                    await self._respond(writer, 503, "Service Unavailable")
+                else:
+                    try:
+                        data = json.loads(body)
+                    except ValueError:
+                        await self._respond(writer, 400, "Bad Request")
+                        continue
+                    if self.route(data):
+                        await self._respond(writer, 200, "OK")
+                    else:
+                        await self._respond(writer, 503, "Service Unavailable")
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        server = await asyncio.start_server(self._handle, LISTEN, PORT)
+        if PUBLIC_URL:
+            async with Bot(cfg['TELEGRAM']['token']) as bot:
+                await bot.set_webhook(PUBLIC_URL.rstrip('/') + URL_PATH,
+                    secret_token=SECRET_TOKEN, max_connections=100)
+        logger.info("Webhook listening on %s:%d%s with %d workers", LISTEN, PORT, URL_PATH, self.workers)
+
+        await stop.wait()
+        logger.info("Draining, %d updates accepted, %d rejected", self.accepted, self.rejected)
+        self._draining = True
+        server.close()
+        await server.wait_closed()
+        if PUBLIC_URL:
+            # otherwise long polling fails with Conflict until it is removed
+            async with Bot(cfg['TELEGRAM']['token']) as bot:
+                await bot.delete_webhook()
+
+    def _drain(self):
+        for updates in self._queues:
+            updates.put(None)
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("%s did not drain in time, killing it", process.name)
+                # workers ignore SIGTERM, see _worker
+                process.kill()
+                process.join()
+
+    def run(self):
+        self._start_workers()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._drain()